@@ -4,13 +4,14 @@
 import pandas as pd
 import numpy as np
 
-from utilities import load_centroids_from_local, distance_cosine_similarity
+from utilities import distance_cosine_similarity
+from centroid_store import LocalCentroidStore
 import config
 
 #
 # main
 #
-centroids = load_centroids_from_local()
+centroids = LocalCentroidStore().load()
 
 list_speakers = sorted(centroids.keys())
 
@@ -4,11 +4,14 @@
 # updated:  1/10/2021 
 #
 import io
-import librosa
+import zlib
+import tarfile
+import zipfile
+import logging
 import numpy as np
 from random import choice
-
-from python_speech_features import fbank
+from functools import lru_cache
+from numpy.lib.stride_tricks import as_strided
 
 # globals
 # global settings
@@ -16,11 +19,28 @@ import config
 
 from constants import SAMPLE_RATE, NUM_FBANKS, NUM_FRAMES
 
+# fast path for wav PCM, librosa is imported only if needed
+from wav_decoder import decode_audio
+
+# timers of the stages
+from metrics import stage
+
+log = logging.getLogger("server")
+
+# parameters of the filter banks, the defaults of python_speech_features.fbank
+# (used to train the model): don't change them
+WINLEN = 0.025
+WINSTEP = 0.01
+NFFT = 512
+PREEMPH = 0.97
+
 
 #
 # extracted from Deep Speader audio to simplify import in Speaker Service
 #
 def read(filename, sample_rate=SAMPLE_RATE):
+        import librosa
+
         audio, sr = librosa.load(filename, sr=sample_rate, mono=True, dtype=np.float32)
         assert sr == sample_rate
         return audio
@@ -32,50 +52,309 @@ def pad_mfcc(mfcc, max_length):  # num_frames, nfilt=64.
 
 def mfcc_fbank(signal: np.array, sample_rate: int):  # 1D signal array.
     # Returns MFCC with shape (num_frames, n_filters, 3).
-    filter_banks, energies = fbank(signal, samplerate=sample_rate, nfilt=NUM_FBANKS)
-    frames_features = normalize_frames(filter_banks)
+    with stage("fbank"):
+        filter_banks, energies = fbank(signal, sample_rate, NUM_FBANKS)
+        frames_features = normalize_frames(filter_banks)
     # delta_1 = delta(filter_banks, N=1)
     # delta_2 = delta(delta_1, N=1)
     # frames_features = np.transpose(np.stack([filter_banks, delta_1, delta_2]), (1, 2, 0))
-    return np.array(frames_features, dtype=np.float32)  # Float32 precision is enough here.
+    return frames_features.astype(np.float32)  # Float32 precision is enough here.
 
+# all the frames in one pass (was: one mean/std per frame)
 def normalize_frames(m, epsilon=1e-12):
-    return [(v - np.mean(v)) / max(np.std(v), epsilon) for v in m]
+    m = np.asarray(m)
+    return (m - np.mean(m, axis=1, keepdims=True)) / np.maximum(np.std(m, axis=1, keepdims=True), epsilon)
+
+#
+# vectorized replacement of python_speech_features.fbank, same results
+# framing with stride tricks (no copy), rfft of all the frames together, cached filterbank
+# returns the filter banks energies (num_frames, nfilt) and the energy of every frame
+#
+def fbank(signal, sample_rate, nfilt):
+    emph = preemphasis(signal)
+
+    frame_len, frame_step = frame_params(sample_rate)
+
+    slen = len(emph)
+    if slen <= frame_len:
+        num_frames = 1
+    else:
+        num_frames = 1 + int(np.ceil((slen - frame_len) / frame_step))
+
+    # zero padded to fill the last frame, as float64 (as python_speech_features)
+    padsignal = np.zeros((num_frames - 1) * frame_step + frame_len)
+    padsignal[:slen] = emph
+
+    return frames_fbank(frame_signal(padsignal, num_frames, frame_len, frame_step), sample_rate, nfilt)
+
+# preemphasis, in the dtype of the signal
+# prev is the sample before signal[0] (streaming), None at the start
+def preemphasis(signal, prev=None):
+    signal = np.asarray(signal)
+
+    emph = np.empty_like(signal)
+    emph[0] = signal[0] if prev is None else signal[0] - PREEMPH * prev
+    emph[1:] = signal[1:] - PREEMPH * signal[:-1]
+
+    return emph
+
+# frame length and step in samples
+def frame_params(sample_rate):
+    frame_len = int(np.floor(WINLEN * sample_rate + 0.5))
+    frame_step = int(np.floor(WINSTEP * sample_rate + 0.5))
+
+    return frame_len, frame_step
+
+# (num_frames, frame_len) overlapping frames, as a view on signal (no copy)
+def frame_signal(signal, num_frames, frame_len, frame_step):
+    return as_strided(signal, shape=(num_frames, frame_len),
+                      strides=(frame_step * signal.strides[0], signal.strides[0]), writeable=False)
+
+def frames_fbank(frames, sample_rate, nfilt):
+    pspec = 1.0 / NFFT * np.square(np.absolute(np.fft.rfft(frames, NFFT)))
+
+    # total energy in each frame
+    energy = np.sum(pspec, 1)
+    energy[energy == 0] = np.finfo(float).eps
+
+    feat = np.dot(pspec, mel_filterbank(nfilt, NFFT, sample_rate))
+    feat[feat == 0] = np.finfo(float).eps
+
+    return feat, energy
+
+#
+# mel filterbank, transposed: (nfft // 2 + 1, nfilt), computed once
+# same as python_speech_features.get_filterbanks (lowfreq = 0, highfreq = sample_rate / 2)
+#
+@lru_cache(maxsize=8)
+def mel_filterbank(nfilt, nfft, sample_rate):
+    highmel = 2595 * np.log10(1 + (sample_rate / 2) / 700.)
+    melpoints = np.linspace(0, highmel, nfilt + 2)
+    bins = np.floor((nfft + 1) * (700 * (10 ** (melpoints / 2595.0) - 1)) / sample_rate)
+
+    i = np.arange(nfft // 2 + 1)
+    left, center, right = bins[:-2, None], bins[1:-1, None], bins[2:, None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rising = np.where((i >= left) & (i < center), (i - left) / (center - left), 0.)
+        falling = np.where((i >= center) & (i < right), (right - i) / (right - center), 0.)
+
+    fb = np.ascontiguousarray((rising + falling).T)
+    fb.flags.writeable = False
+
+    return fb
 
 def read_mfcc(input_filename, sample_rate):
     audio = read(input_filename, sample_rate)
-    energy = np.abs(audio)
-    silence_threshold = np.percentile(energy, 95)
-    offsets = np.where(energy > silence_threshold)[0]
-    # left_blank_duration_ms = (1000.0 * offsets[0]) // self.sample_rate  # frame_id to duration (ms)
-    # right_blank_duration_ms = (1000.0 * (len(audio) - offsets[-1])) // self.sample_rate
-    # TODO: could use trim_silence() here or a better VAD.
-    audio_voice_only = audio[offsets[0]:offsets[-1]]
-    mfcc = mfcc_fbank(audio_voice_only, sample_rate)
-    return mfcc
+    return mfcc_from_audio(audio, sample_rate)
 
 # added (L.S.) for FastAPI endpoint
 def read_mfcc_io(file, sample_rate):
-    audio, sr = librosa.load(io.BytesIO(file), sr=sample_rate, mono=True, dtype=np.float32)
+    with stage("decode"):
+        audio = decode_audio_io(file, sample_rate)
     
     if config.global_settings['IS_DEBUG']:
         print('Audio shape:', audio.shape)
     
+    return mfcc_from_audio(audio, sample_rate)
+
+# as read_mfcc_io, None if file is not a valid audio file (the other clips of a batch go on)
+def try_read_mfcc_io(file, sample_rate):
+    try:
+        return read_mfcc_io(file, sample_rate)
+    except Exception as e:
+        log.error("Invalid audio file: " + str(e))
+        return None
+
+# a limit of identify_batch exceeded by the clips of an archive (413)
+class ArchiveTooLarge(Exception):
+    pass
+
+#
+# the clips (name, bytes) in a zip or tar archive, at most max_clips and max_bytes in total
+# (what is left after the files): number and sizes (from the headers) are checked before a clip
+# is decompressed, the extraction stops at the first limit exceeded (ArchiveTooLarge)
+#
+def read_archive(content, max_clips, max_bytes):
+    max_clip_bytes = config.global_settings['IDENTIFY_BATCH_MAX_CLIP_BYTES']
+
+    clips = []
+    total_bytes = 0
+
+    def admit(name, size):
+        nonlocal total_bytes
+
+        if len(clips) >= max_clips:
+            raise ArchiveTooLarge("Too many clips, max is " + str(config.global_settings['IDENTIFY_BATCH_MAX_CLIPS']))
+
+        if size > max_clip_bytes:
+            raise ArchiveTooLarge("Clip " + name + " too large, max is " + str(max_clip_bytes) + " bytes")
+
+        total_bytes += size
+
+        if total_bytes > max_bytes:
+            raise ArchiveTooLarge("Clips too large, max is " + str(config.global_settings['IDENTIFY_BATCH_MAX_BYTES']) +
+                                  " bytes in total")
+
+    if zipfile.is_zipfile(io.BytesIO(content)):
+        with zipfile.ZipFile(io.BytesIO(content)) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    admit(info.filename, info.file_size)
+
+                    # no more than the size in the header
+                    with zf.open(info) as fp:
+                        clips.append((info.filename, fp.read(info.file_size)))
+    else:
+        with tarfile.open(fileobj=io.BytesIO(content), mode="r:*") as tf:
+            # member by member (not getmembers): stops at the first limit exceeded
+            for member in tf:
+                if member.isfile():
+                    admit(member.name, member.size)
+
+                    clips.append((member.name, tf.extractfile(member).read(member.size)))
+
+    return clips
+
+# decode the bytes of an audio file (as uploaded) in a float32 mono signal
+# wav PCM at sample_rate is decoded directly, the rest with librosa
+def decode_audio_io(file, sample_rate):
+    audio, path = decode_audio(file, sample_rate)
+
+    if config.global_settings['IS_DEBUG']:
+        print('Decoding path:', path)
+
+    return audio
+
+# features from an already decoded signal (or a segment of it)
+def mfcc_from_audio(audio, sample_rate):
+    with stage("vad"):
+        audio_voice_only = voice_only(audio, sample_rate)
+    mfcc = mfcc_fbank(audio_voice_only, sample_rate)
+    return mfcc
+
+# silence removal before the features (VAD_MODE)
+# energy: frame level energy VAD, percentile: the original trim, none: all the audio
+VAD_MODES = ("energy", "percentile", "none")
+
+def voice_only(audio, sample_rate, mode=None):
+    if mode is None:
+        mode = config.global_settings['VAD_MODE']
+
+    if mode == "energy":
+        return vad_energy(audio, sample_rate)
+    elif mode == "percentile":
+        return trim_percentile(audio)
+
+    return audio
+
+# the original trim: from the first to the last sample above the 95 percentile of |audio|
+def trim_percentile(audio):
     energy = np.abs(audio)
     silence_threshold = np.percentile(energy, 95)
     offsets = np.where(energy > silence_threshold)[0]
     # left_blank_duration_ms = (1000.0 * offsets[0]) // self.sample_rate  # frame_id to duration (ms)
     # right_blank_duration_ms = (1000.0 * (len(audio) - offsets[-1])) // self.sample_rate
-    # TODO: could use trim_silence() here or a better VAD.
-    audio_voice_only = audio[offsets[0]:offsets[-1]]
-    mfcc = mfcc_fbank(audio_voice_only, sample_rate)
-    return mfcc
+    return audio[offsets[0]:offsets[-1]]
+
+#
+# frame level energy VAD, one pass on the signal
+# the audio is split in blocks of one frame step (10 ms), a block is speech if its energy (dB)
+# is within VAD_DYNAMIC_RANGE_DB of the loudest one and above VAD_FLOOR_DB,
+# VAD_HANGOVER_FRAMES blocks are kept around speech (onsets, offsets, short pauses)
+# returns the speech blocks, concatenated (all the audio if no block is speech)
+#
+def vad_energy(audio, sample_rate):
+    _, step = frame_params(sample_rate)
+
+    mask = vad_mask(audio, step)
+
+    # no speech found, or all speech
+    if not mask.any() or mask.all():
+        return audio
+
+    blocks = audio[:len(mask) * step].reshape(len(mask), step)
+
+    return blocks[mask].reshape(-1)
+
+# speech flag for every (complete) block of step samples
+def vad_mask(audio, step):
+    num_blocks = len(audio) // step
+
+    if num_blocks == 0:
+        return np.zeros(0, dtype=bool)
+
+    blocks = audio[:num_blocks * step].reshape(num_blocks, step)
+
+    # mean power of the blocks, in dB (full scale = 0 dB)
+    power = np.einsum('ij,ij->i', blocks, blocks, dtype=np.float64) / step
+    db = 10. * np.log10(power + 1e-12)
+
+    threshold = max(db.max() - config.global_settings['VAD_DYNAMIC_RANGE_DB'], config.global_settings['VAD_FLOOR_DB'])
+    mask = db > threshold
+
+    # hangover: dilation of the mask, with a running sum
+    hangover = config.global_settings['VAD_HANGOVER_FRAMES']
+
+    if hangover > 0:
+        csum = np.concatenate(([0], np.cumsum(mask)))
+        idx = np.arange(num_blocks)
+        lo = np.maximum(idx - hangover, 0)
+        hi = np.minimum(idx + hangover + 1, num_blocks)
+        mask = (csum[hi] - csum[lo]) > 0
+
+    return mask
+
+# crop policies for sample_from_mfcc (CROP_POLICY)
+# random: a random window (not reproducible), center: the central window,
+# seeded: a pseudo-random window, but always the same for the same audio (and CROP_SEED)
+CROP_POLICIES = ("random", "center", "seeded")
+
+def sample_from_mfcc(mfcc, max_length, policy=None):
+    if policy is None:
+        policy = config.global_settings['CROP_POLICY']
 
-def sample_from_mfcc(mfcc, max_length):
     if mfcc.shape[0] >= max_length:
-        r = choice(range(0, len(mfcc) - max_length + 1))
+        r = crop_start(mfcc, max_length, policy)
         s = mfcc[r:r + max_length]
     else:
         s = pad_mfcc(mfcc, max_length)
     return np.expand_dims(s, axis=-1)
 
+# the first frame of the window, with the crop policy
+def crop_start(mfcc, max_length, policy):
+    last = len(mfcc) - max_length
+
+    if policy == "random":
+        return choice(range(0, last + 1))
+    if policy == "center":
+        return last // 2
+    if policy == "seeded":
+        # the seed depends on the content: identical audio, identical window
+        seed = zlib.crc32(np.ascontiguousarray(mfcc).tobytes(), config.global_settings['CROP_SEED'])
+        return int(np.random.default_rng(seed).integers(0, last + 1))
+
+    raise ValueError("Unknown crop policy: " + str(policy))
+
+#
+# all the utterance (not a single random crop): overlapping windows of max_length frames
+# every stride frames, at most max_windows (evenly spaced) to bound the latency
+# returns (num_windows, max_length, n_filters, 1)
+#
+def tile_mfcc(mfcc, max_length, stride, max_windows):
+    if mfcc.shape[0] < max_length:
+        return np.expand_dims(sample_from_mfcc(mfcc, max_length), axis=0)
+
+    last = len(mfcc) - max_length
+    starts = np.arange(0, last + 1, stride)
+
+    # the tail of the utterance is covered too
+    if starts[-1] != last:
+        starts = np.append(starts, last)
+
+    if len(starts) > max_windows:
+        starts = np.unique(np.round(np.linspace(0, last, max_windows)).astype(int))
+
+    windows = np.stack([mfcc[s:s + max_length] for s in starts])
+
+    return np.expand_dims(windows, axis=-1)
@@ -0,0 +1,97 @@
+#
+# Micro-batching of the inference requests
+# concurrent requests (identify, verify, add_speaker) are collected for up to
+# BATCH_WINDOW_MS (or BATCH_MAX_SIZE items) and the model runs one batched forward pass
+# updated:  18/10/2026
+#
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+# global configs
+import config
+
+from metrics import stage, BATCH_SIZE
+
+log = logging.getLogger("server")
+
+#
+# sits in front of the model and exposes the same embed(batch) method
+# so it can be passed everywhere the model is used (compute_embeddings, add_speaker)
+#
+class BatchingEngine:
+    def __init__(self, model, window_ms=None, max_size=None):
+        self.model = model
+        self.window = (window_ms if window_ms is not None else config.global_settings['BATCH_WINDOW_MS']) / 1000.
+        self.max_size = max_size if max_size is not None else config.global_settings['BATCH_MAX_SIZE']
+
+        self.requests = queue.Queue()
+
+        self.worker = threading.Thread(target=self._run, name="batching-engine", daemon=True)
+        self.worker.start()
+
+    #
+    # batch has shape (B, NUM_FRAMES, NUM_FBANKS, 1), returns (B, EMBEDDING_DIMS)
+    # blocks the caller until its own embeddings are ready
+    #
+    def embed(self, batch):
+        future = Future()
+        self.requests.put((batch, future))
+
+        return future.result()
+
+    #
+    # collect requests until the window expires or the batch is full
+    #
+    def _collect(self):
+        pending = [self.requests.get()]
+        num_items = len(pending[0][0])
+
+        deadline = time.monotonic() + self.window
+
+        while num_items < self.max_size:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+            pending.append(item)
+            num_items += len(item[0])
+
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+
+            try:
+                batch = np.concatenate([b for b, _ in pending], axis=0)
+
+                if config.global_settings['IS_DEBUG']:
+                    print('Batch size is:', batch.shape[0])
+
+                BATCH_SIZE.observe(len(batch))
+
+                # the forward pass only (embed includes the wait in the batch window)
+                with stage("inference"):
+                    embeddings = self.model.embed(batch)
+            except Exception as e:
+                log.error("Batched inference failed: " + str(e))
+
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            # hand each caller its own slice
+            start = 0
+            for b, future in pending:
+                future.set_result(embeddings[start:start + len(b)])
+                start += len(b)
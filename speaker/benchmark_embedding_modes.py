@@ -0,0 +1,78 @@
+#
+# accuracy vs latency of the embedding modes:
+# single (one window of NUM_FRAMES frames) vs multi (average of many windows, MULTI_WINDOW_MAX)
+#
+# the test clips are in a dir with a subdir for every speaker (named as in the centroids DB):
+#   data_dir/Luigi_Saetta/clip1.wav ...
+#
+# usage: python benchmark_embedding_modes.py data_dir [--max-windows 2 4 8 16 32]
+#
+import os
+import glob
+import time
+import argparse
+
+import config
+
+from conv_models import DeepSpeakerModel
+from centroid_index import CentroidIndex
+from utilities import compute_embeddings, create_path
+from centroid_store import LocalCentroidStore
+
+def load_clips(data_dir):
+    clips = []
+
+    for speaker in sorted(os.listdir(data_dir)):
+        for f_name in sorted(glob.glob(os.path.join(data_dir, speaker, "*.wav"))):
+            with open(f_name, "rb") as f:
+                clips.append((speaker, f.read()))
+
+    return clips
+
+#
+# top-1 accuracy and ms per clip
+#
+def evaluate(clips, model, index, mode):
+    correct = 0
+
+    tStart = time.time()
+    for speaker, file in clips:
+        embedding = compute_embeddings(file, model, mode)
+
+        if index.search(embedding, 1)[0][0] == speaker:
+            correct += 1
+    tEla = time.time() - tStart
+
+    return correct / len(clips), 1000. * tEla / len(clips)
+
+#
+# Main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Accuracy vs latency of single and multi window embeddings")
+    parser.add_argument("data_dir")
+    parser.add_argument("--max-windows", type=int, nargs="+", default=[2, 4, 8, 16, 32])
+    parser.add_argument("--repeat", type=int, default=3, help="single crop is random: average of runs")
+    args = parser.parse_args()
+
+    model = DeepSpeakerModel()
+    model.m.load_weights(create_path(config.global_settings['MODEL_FILE']), by_name=True)
+    model.warm_up()
+
+    index = CentroidIndex.from_dict(LocalCentroidStore().load())
+
+    clips = load_clips(args.data_dir)
+    print("clips:", len(clips))
+    print()
+    print("%-20s %10s %12s %18s" % ("mode", "top-1", "ms/clip", "top-1 per 100 ms"))
+
+    results = [evaluate(clips, model, index, "single") for _ in range(args.repeat)]
+    acc = sum(r[0] for r in results) / args.repeat
+    ms = sum(r[1] for r in results) / args.repeat
+    print("%-20s %10.3f %12.1f %18.3f" % ("single", acc, ms, 100. * acc / ms))
+
+    for max_windows in args.max_windows:
+        config.global_settings['MULTI_WINDOW_MAX'] = max_windows
+
+        acc, ms = evaluate(clips, model, index, "multi")
+        print("%-20s %10.3f %12.1f %18.3f" % ("multi max=%d" % max_windows, acc, ms, 100. * acc / ms))
@@ -0,0 +1,67 @@
+#
+# parity check and micro-benchmark of the filter banks front end:
+# the vectorized mfcc_fbank vs python_speech_features.fbank + per-frame normalization
+# (the original implementation, the model has been trained with it)
+#
+# usage: python benchmark_features.py [--seconds 1 10 60] [--wav file.wav]
+# needs python_speech_features (only here, as the reference)
+#
+import argparse
+import time
+import numpy as np
+
+from python_speech_features import fbank as reference_fbank
+
+from audio_utils_new import mfcc_fbank
+from constants import SAMPLE_RATE, NUM_FBANKS
+
+#
+# the original implementation
+#
+def reference_mfcc_fbank(signal, sample_rate):
+    filter_banks, energies = reference_fbank(signal, samplerate=sample_rate, nfilt=NUM_FBANKS)
+    frames_features = [(v - np.mean(v)) / max(np.std(v), 1e-12) for v in filter_banks]
+    return np.array(frames_features, dtype=np.float32)
+
+def time_fn(fn, signal, repeat):
+    tStart = time.time()
+    for _ in range(repeat):
+        fn(signal, SAMPLE_RATE)
+
+    return 1000. * (time.time() - tStart) / repeat
+
+#
+# Main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parity and speed of the filter banks front end")
+    parser.add_argument("--seconds", type=float, nargs="+", default=[1, 10, 60])
+    parser.add_argument("--wav", help="use this wav file instead of synthetic audio")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    signals = []
+
+    if args.wav:
+        from audio_utils_new import read
+        signals.append((args.wav, read(args.wav, SAMPLE_RATE)))
+    else:
+        rng = np.random.default_rng(1234)
+        for sec in args.seconds:
+            signals.append(("%g s" % sec, (0.1 * rng.standard_normal(int(sec * SAMPLE_RATE))).astype(np.float32)))
+
+    print("%-20s %12s %15s %15s %10s" % ("audio", "max |diff|", "reference (ms)", "vectorized (ms)", "speedup"))
+
+    for label, signal in signals:
+        ref = reference_mfcc_fbank(signal, SAMPLE_RATE)
+        new = mfcc_fbank(signal, SAMPLE_RATE)
+
+        # parity: same shape, same values (the pretrained model.h5 relies on it)
+        assert ref.shape == new.shape, "Shapes differ: %s %s" % (ref.shape, new.shape)
+        max_diff = float(np.max(np.abs(ref - new)))
+        assert max_diff < 1e-5, "Features differ: " + str(max_diff)
+
+        ms_ref = time_fn(reference_mfcc_fbank, signal, args.repeat)
+        ms_new = time_fn(mfcc_fbank, signal, args.repeat)
+
+        print("%-20s %12.2e %15.2f %15.2f %9.1fx" % (label, max_diff, ms_ref, ms_new, ms_ref / ms_new))
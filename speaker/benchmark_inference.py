@@ -0,0 +1,53 @@
+#
+# benchmark of the per-call inference overhead:
+# Keras predict vs the traced tf.function entry point (DeepSpeakerModel.embed)
+#
+# usage: python benchmark_inference.py --calls 100 --batch-sizes 1 8 32
+#
+import argparse
+import time
+import numpy as np
+
+import config
+
+from conv_models import DeepSpeakerModel
+from constants import NUM_FRAMES, NUM_FBANKS
+from utilities import create_path
+
+def time_calls(fn, batch, calls):
+    # first call excluded (tracing, allocations)
+    fn(batch)
+
+    tStart = time.time()
+    for _ in range(calls):
+        fn(batch)
+
+    return 1000. * (time.time() - tStart) / calls
+
+#
+# Main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-call overhead of Keras predict vs tf.function")
+    parser.add_argument("--calls", type=int, default=100)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--no-weights", action="store_true", help="don't load model.h5 (timing only)")
+    args = parser.parse_args()
+
+    model = DeepSpeakerModel()
+
+    if not args.no_weights:
+        model.m.load_weights(create_path(config.global_settings['MODEL_FILE']), by_name=True)
+
+    print("%-12s %15s %15s %15s" % ("batch size", "predict (ms)", "embed (ms)", "saved (ms)"))
+
+    for batch_size in args.batch_sizes:
+        batch = np.random.standard_normal((batch_size, NUM_FRAMES, NUM_FBANKS, 1)).astype(np.float32)
+
+        ms_predict = time_calls(model.m.predict, batch, args.calls)
+        ms_embed = time_calls(model.embed, batch, args.calls)
+
+        # same results on both paths
+        assert np.allclose(model.m.predict(batch), model.embed(batch), atol=1e-5)
+
+        print("%-12d %15.2f %15.2f %15.2f" % (batch_size, ms_predict, ms_embed, ms_predict - ms_embed))
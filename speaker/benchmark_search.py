@@ -0,0 +1,112 @@
+#
+# benchmark of the search backends: exact scan vs ivf (approximate)
+# reports recall@k (taking exact as the reference) and latency per query
+# on a synthetic DB, or on the current centroids DB (--db) with synthetic queries
+#
+# usage: python benchmark_search.py --num-speakers 200000 --nprobe 1 4 8 16 32
+#        python benchmark_search.py --db --nprobe 1 4 8 16 32
+#
+import argparse
+import time
+import numpy as np
+
+import config
+
+from centroid_index import CentroidIndex, IVFCentroidIndex, centroids_to_matrix
+from centroid_store import create_store
+
+#
+# synthetic DB: unit vectors with a weak cluster structure (as real embeddings: speakers of the
+# same group, e.g. gender or language, have cosine ~0.2, the others ~0)
+# cluster_weight: weight of the group direction, 0.5 gives cosine ~0.2 in the group
+#
+def make_db(num_speakers, dims, cluster_weight, rng):
+    num_groups = max(1, num_speakers // 100)
+    groups = rng.standard_normal((num_groups, dims)).astype(np.float32)
+
+    matrix = cluster_weight * groups[rng.integers(0, num_groups, num_speakers)] + \
+        rng.standard_normal((num_speakers, dims)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    names = ["speaker_%d" % i for i in range(num_speakers)]
+
+    return names, matrix
+
+#
+# queries: new clips of enrolled speakers, the centroid plus noise
+# query_noise: norm of the noise (the centroid has norm one), 1.0 gives cosine ~0.7 with the centroid
+#
+def make_queries(matrix, num_queries, query_noise, rng):
+    dims = matrix.shape[1]
+
+    noise = rng.standard_normal((num_queries, dims)).astype(np.float32) * np.float32(query_noise / np.sqrt(dims))
+
+    queries = matrix[rng.integers(0, len(matrix), num_queries)] + noise
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    return queries
+
+# the current centroids DB (CONFIG_TYPE, CENTROIDS_FORMAT)
+def load_db():
+    centroids = create_store().load()
+
+    return list(centroids.keys()), centroids_to_matrix(centroids)
+
+def run_queries(index, queries, k):
+    results = []
+
+    tStart = time.time()
+    for q in queries:
+        results.append([name for name, _ in index.search(q, k)])
+    tEla = time.time() - tStart
+
+    return results, 1000. * tEla / len(queries)
+
+def recall(results, reference):
+    hits = sum(len(set(r) & set(ref)) for r, ref in zip(results, reference))
+    total = sum(len(ref) for ref in reference)
+
+    return hits / total
+
+#
+# Main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recall/latency benchmark of the search backends")
+    parser.add_argument("--num-speakers", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=config.global_settings['MAX_RESULTS'])
+    parser.add_argument("--nlist", type=int, default=config.global_settings['IVF_NLIST'])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--cluster-weight", type=float, default=0.5, help="cluster structure of the synthetic DB")
+    parser.add_argument("--query-noise", type=float, default=1.0, help="distance of the queries from the centroids")
+    parser.add_argument("--db", action="store_true", help="the current centroids DB instead of a synthetic one")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1234)
+
+    if args.db:
+        names, matrix = load_db()
+        args.num_speakers = len(names)
+    else:
+        names, matrix = make_db(args.num_speakers, config.global_settings['EMBEDDING_DIMS'], args.cluster_weight, rng)
+
+    queries = make_queries(matrix, args.queries, args.query_noise, rng)
+
+    exact = CentroidIndex(names, matrix)
+    reference, ms_exact = run_queries(exact, queries, args.k)
+
+    print("speakers: %d, queries: %d, k: %d" % (args.num_speakers, args.queries, args.k))
+    print()
+    print("%-20s %10s %12s" % ("backend", "recall@k", "ms/query"))
+    print("%-20s %10.3f %12.3f" % ("exact", 1.0, ms_exact))
+
+    tStart = time.time()
+    ivf = IVFCentroidIndex(names, matrix, nlist=args.nlist)
+    print("(ivf build with nlist = %d: %.1f sec.)" % (ivf.nlist, time.time() - tStart))
+
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        results, ms_ivf = run_queries(ivf, queries, args.k)
+
+        print("%-20s %10.3f %12.3f" % ("ivf nprobe=%d" % nprobe, recall(results, reference), ms_ivf))
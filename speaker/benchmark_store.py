@@ -0,0 +1,85 @@
+#
+# I/O of the centroids DB on every backend of the CentroidStore, for the json and bin formats:
+# time (ms) of write_new, publish (backup + swap), load (read and check) and of a load
+# of an unchanged file (the version is checked, the file is not read again)
+# Object Storage is replaced by local stand-ins: fsspec "file" (in a temp dir) and "memory"
+#
+# usage: python benchmark_store.py [--num-speakers 10000] [--repeat 5]
+#
+import os
+import argparse
+import logging
+import tempfile
+import time
+import numpy as np
+
+import config
+
+from centroid_store import LocalCentroidStore, FsspecCentroidStore, MemoryCentroidStore
+
+def random_centroids(num_speakers, rng):
+    matrix = rng.standard_normal((num_speakers, config.global_settings['EMBEDDING_DIMS'])).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+
+    # same structure of the DB: name -> (1, EMBEDDING_DIMS)
+    return {"speaker_%06d" % i: matrix[i:i + 1] for i in range(num_speakers)}
+
+def timed(fn, repeat):
+    tStart = time.time()
+    for _ in range(repeat):
+        fn()
+
+    return 1000. * (time.time() - tStart) / repeat
+
+def load_cold(store):
+    store.loaded.clear()
+    store.load()
+
+def measure(store, centroids, repeat):
+    ms_write = timed(lambda: store.write_new(centroids), repeat)
+    ms_publish = timed(store.publish, repeat)
+    ms_load = timed(lambda: load_cold(store), repeat)
+    ms_unchanged = timed(store.load, repeat)
+
+    return ms_write, ms_publish, ms_load, ms_unchanged
+
+def create_stores(tmp_dir):
+    import fsspec
+
+    return [
+        ("local", LocalCentroidStore(tmp_dir + "/local")),
+        ("fsspec file", FsspecCentroidStore(fsspec.filesystem("file"), tmp_dir + "/fsspec/")),
+        ("fsspec memory", FsspecCentroidStore(fsspec.filesystem("memory"), "memory://bench/")),
+        ("memory", MemoryCentroidStore()),
+    ]
+
+#
+# Main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="I/O of the centroids DB per backend")
+    parser.add_argument("--num-speakers", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    # the checks of the DB log at every load
+    logging.getLogger("server").setLevel(logging.WARNING)
+
+    centroids = random_centroids(args.num_speakers, np.random.default_rng(1234))
+
+    print("speakers: %d" % args.num_speakers)
+    print()
+    print("%-8s %-16s %12s %12s %12s %16s" % ("format", "backend", "write (ms)", "publish (ms)", "load (ms)",
+                                             "unchanged (ms)"))
+
+    for fmt in ("json", "bin"):
+        config.global_settings['CENTROIDS_FORMAT'] = fmt
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(tmp_dir + "/local")
+            os.makedirs(tmp_dir + "/fsspec")
+
+            for name, store in create_stores(tmp_dir):
+                results = measure(store, centroids, args.repeat)
+
+                print("%-8s %-16s %12.1f %12.1f %12.1f %16.2f" % ((fmt, name) + results))
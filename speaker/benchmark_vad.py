@@ -0,0 +1,82 @@
+#
+# compute saved by the silence removal (VAD_MODE): for every clip the seconds of audio
+# that reach the features, the frames given to the model (multi window mode) and the times
+# of VAD + filter banks (sums over the clips), for the energy VAD vs the original percentile trim vs none
+#
+# usage: python benchmark_vad.py call1.wav call2.wav ... (real recordings, with long silences)
+#        python benchmark_vad.py (synthetic: bursts of noise between silences)
+#
+import argparse
+import time
+import numpy as np
+
+import config
+
+from audio_utils_new import VAD_MODES, voice_only, mfcc_fbank, tile_mfcc
+from constants import SAMPLE_RATE, NUM_FRAMES
+
+#
+# speech-like bursts (modulated noise) separated by low level noise
+#
+def synthetic_call(seconds, rng):
+    audio = []
+    total = 0.
+
+    while total < seconds:
+        silence = rng.uniform(1., 4.)
+        speech = rng.uniform(0.5, 3.)
+
+        n = int(speech * SAMPLE_RATE)
+        audio.append(0.001 * rng.standard_normal(int(silence * SAMPLE_RATE)))
+        audio.append(0.2 * rng.standard_normal(n) * np.abs(np.sin(np.linspace(0, 8 * np.pi * speech, n))))
+
+        total += silence + speech
+
+    return np.concatenate(audio).astype(np.float32)
+
+def measure(audio, mode, repeat):
+    tStart = time.time()
+    for _ in range(repeat):
+        voiced = voice_only(audio, SAMPLE_RATE, mode)
+    ms_vad = 1000. * (time.time() - tStart) / repeat
+
+    tStart = time.time()
+    for _ in range(repeat):
+        mfcc = mfcc_fbank(voiced, SAMPLE_RATE)
+    ms_fbank = 1000. * (time.time() - tStart) / repeat
+
+    # windows embedded by the model in multi mode, without the cap MULTI_WINDOW_MAX
+    windows = len(tile_mfcc(mfcc, NUM_FRAMES, config.global_settings['MULTI_WINDOW_STRIDE'], len(mfcc)))
+
+    return len(voiced) / SAMPLE_RATE, ms_vad, ms_fbank, len(mfcc), windows
+
+#
+# Main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Audio, features and model compute saved by the VAD")
+    parser.add_argument("wav", nargs="*", help="recordings (default: synthetic calls)")
+    parser.add_argument("--seconds", type=float, default=60, help="length of the synthetic calls")
+    parser.add_argument("--num-clips", type=int, default=5, help="number of synthetic calls")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.wav:
+        from audio_utils_new import read
+        clips = [read(f_name, SAMPLE_RATE) for f_name in args.wav]
+    else:
+        rng = np.random.default_rng(1234)
+        clips = [synthetic_call(args.seconds, rng) for _ in range(args.num_clips)]
+
+    total = sum(len(audio) for audio in clips) / SAMPLE_RATE
+    print("clips: %d, audio: %.1f sec." % (len(clips), total))
+    print()
+    print("%-12s %12s %10s %10s %12s %10s %10s" % ("VAD_MODE", "kept (sec)", "kept (%)", "VAD (ms)", "fbank (ms)",
+                                                  "frames", "windows"))
+
+    for mode in VAD_MODES:
+        results = np.array([measure(audio, mode, args.repeat) for audio in clips])
+        kept, ms_vad, ms_fbank, frames, windows = results.sum(axis=0)
+
+        print("%-12s %12.1f %10.1f %10.2f %12.2f %10d %10d" % (mode, kept, 100. * kept / total, ms_vad, ms_fbank,
+                                                            frames, windows))
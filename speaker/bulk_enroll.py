@@ -0,0 +1,295 @@
+#
+# Bulk enrollment: builds the centroids DB for many speakers at once
+# (instead of one add_speaker call, one DB rewrite and one swap per speaker)
+#
+# the input dir contains one subdir per speaker (all the audio files in it are used)
+# or one audio file per speaker (the name is the file name, without extension):
+#   data_dir/Luigi_Saetta/clip1.wav, data_dir/Luigi_Saetta/clip2.wav, data_dir/Mario_Rossi.wav ...
+#
+# decode and features in a pool of processes, the embeddings in large batches on the model
+# (in this process), the centroids (as in add_speaker) written once as the new snapshot
+# (NEW_CENTROIDS_FILE_NAME, with --swap it becomes the current one).
+# The centroids computed are saved in a state file: if interrupted, the same command resumes.
+# The state file is bound to the data dir and to the features settings (first record), the speakers
+# with errors are tried again at the next run.
+# With --swap only the changes in the enrollment log read here (now in the snapshot) are removed,
+# the ones made meanwhile by a running service are kept.
+#
+# usage: python bulk_enroll.py data_dir [--workers 8] [--swap] [--replace]
+# updated:  18/10/2026
+#
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+# global configs
+import config
+
+from constants import SAMPLE_RATE
+from audio_utils_new import decode_audio_io
+from speaker_management import speaker_windows, compute_centroid
+from utilities import embed_mfcc_batch, create_path
+from centroid_store import create_store, features_settings
+from enrollment_log import EnrollmentLog, replay
+
+log = logging.getLogger("server")
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".ogg", ".m4a")
+
+#
+# (speaker name, list of audio files), sorted by name
+#
+def find_speakers(data_dir):
+    speakers = []
+
+    for entry in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, entry)
+
+        if os.path.isdir(path):
+            files = [os.path.join(path, f_name) for f_name in sorted(os.listdir(path))
+                     if f_name.lower().endswith(AUDIO_EXTENSIONS)]
+
+            if len(files) > 0:
+                speakers.append((entry, files))
+        elif entry.lower().endswith(AUDIO_EXTENSIONS):
+            speakers.append((os.path.splitext(entry)[0], [path]))
+
+    return speakers
+
+#
+# in the pool processes: decode and mfcc windows of all the files of a speaker
+# returns (name, windows (S, NUM_FRAMES, NUM_FBANKS, 1) or None, seconds of audio, error)
+#
+def load_speaker(name, files):
+    windows = []
+    seconds = 0.
+
+    try:
+        for f_name in files:
+            with open(f_name, "rb") as f:
+                audio = decode_audio_io(f.read(), SAMPLE_RATE)
+
+            seconds += len(audio) / SAMPLE_RATE
+            windows.extend(speaker_windows(audio))
+    except Exception as e:
+        return name, None, seconds, str(e)
+
+    if len(windows) == 0:
+        return name, None, seconds, "audio is too short"
+
+    return name, np.stack(windows).astype(np.float32), seconds, None
+
+#
+# the state file: a header (data dir and features settings), then
+# one json record per speaker done (the centroid, or the error)
+#
+def state_header(data_dir):
+    return {"data_dir": os.path.abspath(data_dir), "features": features_settings()}
+
+#
+# the speakers done, the ones with errors are not: they are tried again
+# exits if the state file has been written for another data dir or other settings
+#
+def read_state(state_file, data_dir):
+    done = {}
+
+    if not os.path.exists(state_file) or os.path.getsize(state_file) == 0:
+        return done
+
+    with open(state_file, "r") as fp:
+        for i, line in enumerate(fp):
+            # a partial last line (interrupted while writing) is ignored
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+
+            if i == 0:
+                if record.get("header") != state_header(data_dir):
+                    sys.exit("State file " + state_file + " is for another data dir or other settings: " +
+                             json.dumps(record.get("header")) + ". Remove it or use another --state")
+                continue
+
+            if "centroid" in record:
+                done[record["name"]] = record
+
+    return done
+
+def write_state_header(fp, data_dir):
+    if fp.tell() == 0:
+        append_state(fp, [{"header": state_header(data_dir)}])
+
+def append_state(fp, records):
+    for record in records:
+        fp.write(json.dumps(record) + "\n")
+
+    fp.flush()
+    os.fsync(fp.fileno())
+
+#
+# embeddings for the speakers in pending, in one pass (chunks of EMBEDDING_BATCH_SIZE)
+# returns the state records
+#
+def embed_speakers(pending, model):
+    embeddings = embed_mfcc_batch([w for _, windows in pending for w in windows], model)
+
+    records = []
+    start = 0
+
+    for name, windows in pending:
+        centroid = compute_centroid(embeddings[start:start + len(windows)])
+        start += len(windows)
+
+        records.append({"name": name, "centroid": centroid.astype(np.float64).tolist()})
+
+    return records
+
+#
+# the DB the new speakers are added to: current snapshot + enrollment log (as the server loads it)
+# (with replace only the log is read: its records are discarded with the swap)
+#
+def load_current_centroids(store, enrollment_log, replace):
+    records = enrollment_log.read()
+
+    if replace:
+        return {}
+
+    return replay(store.load(), records)
+
+def write_snapshot(store, enrollment_log, new_centroids, swap):
+    store.write_new(new_centroids)
+
+    if swap:
+        store.publish()
+
+        # only the changes read in load_current_centroids: the ones of a running service are kept
+        enrollment_log.truncate()
+
+# imported here: the pool processes (spawn) import this module, but don't need TensorFlow
+def load_model():
+    from conv_models import DeepSpeakerModel
+
+    model = DeepSpeakerModel()
+    model.m.load_weights(create_path(config.global_settings['MODEL_FILE']), by_name=True)
+    model.warm_up()
+
+    return model
+
+#
+# Main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Enroll all the speakers in a dir in the centroids DB")
+    parser.add_argument("data_dir")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes for decode and features")
+    parser.add_argument("--batch-windows", type=int, default=2048,
+                        help="windows collected before running the model on them")
+    parser.add_argument("--batch-size", type=int, default=256, help="windows in a forward pass of the model")
+    parser.add_argument("--state", default="bulk_enroll_state.jsonl", help="progress, to resume")
+    parser.add_argument("--replace", action="store_true", help="only the enrolled speakers, not added to the DB")
+    parser.add_argument("--swap", action="store_true", help="the new snapshot becomes the current DB")
+    args = parser.parse_args()
+
+    config.global_settings['EMBEDDING_BATCH_SIZE'] = args.batch_size
+
+    speakers = find_speakers(args.data_dir)
+    done = read_state(args.state, args.data_dir)
+    todo = [(name, files) for name, files in speakers if name not in done]
+
+    print("speakers: %d, already done: %d, to do: %d" % (len(speakers), len(speakers) - len(todo), len(todo)))
+
+    # spawn: the processes don't inherit the model (TensorFlow is not fork safe)
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    model = load_model()
+
+    num_done = 0
+    seconds = 0.
+    errors = 0
+    t_model = 0.
+
+    pending = []
+    pending_windows = 0
+
+    tStart = time.time()
+
+    with pool, open(args.state, "a") as state_fp:
+        write_state_header(state_fp, args.data_dir)
+
+        # bounded number of speakers in flight (the windows are in memory until embedded)
+        it = iter(todo)
+        futures = set()
+
+        while True:
+            while len(futures) < 4 * args.workers:
+                try:
+                    name, files = next(it)
+                except StopIteration:
+                    break
+                futures.add(pool.submit(load_speaker, name, files))
+
+            if len(futures) == 0 and len(pending) == 0:
+                break
+
+            if len(futures) > 0:
+                completed, futures = wait(futures, return_when=FIRST_COMPLETED)
+            else:
+                completed = []
+
+            records = []
+
+            for future in completed:
+                name, windows, sec, error = future.result()
+                seconds += sec
+
+                if error is not None:
+                    log.error("Speaker " + name + " skipped: " + error)
+                    records.append({"name": name, "error": error})
+                    errors += 1
+                else:
+                    pending.append((name, windows))
+                    pending_windows += len(windows)
+
+            # a large batch for the model, or the last one
+            if pending_windows >= args.batch_windows or (len(futures) == 0 and len(pending) > 0):
+                tModel = time.time()
+                records.extend(embed_speakers(pending, model))
+                t_model += time.time() - tModel
+
+                pending = []
+                pending_windows = 0
+
+            if len(records) > 0:
+                append_state(state_fp, records)
+                num_done += len(records)
+
+                tEla = time.time() - tStart
+                print("done %d/%d, %.1f speakers/s, %.1f audio sec/s" % (num_done, len(todo), num_done / tEla,
+                                                                         seconds / tEla))
+
+    tEla = time.time() - tStart
+
+    print()
+    print("Speakers processed: %d (errors: %d) in %.1f sec." % (num_done, errors, tEla))
+    if num_done > 0:
+        print("Throughput: %.2f speakers/s, %.1f audio sec/s" % (num_done / tEla, seconds / tEla))
+        print("Model time: %.1f sec., features (in parallel) and other: %.1f sec." % (t_model, tEla - t_model))
+
+    # all the speakers (also from previous runs) in one new snapshot
+    store = create_store()
+    enrollment_log = EnrollmentLog(store)
+    new_centroids = load_current_centroids(store, enrollment_log, args.replace)
+
+    for record in read_state(args.state, args.data_dir).values():
+        new_centroids[record["name"]] = np.array(record["centroid"])
+
+    write_snapshot(store, enrollment_log, new_centroids, args.swap)
+
+    print("New centroids DB written, number of speakers: %d" % len(new_centroids))
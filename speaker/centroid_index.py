@@ -0,0 +1,423 @@
+#
+# In-memory index over the centroids DB
+# used by identify and verify to score an embedding against all the speakers
+# updated:  18/10/2026
+#
+import copy
+import threading
+
+import numpy as np
+
+# global configs
+import config
+
+#
+# the centroids (dict name -> [[512 floats]]) are packed in a single contiguous
+# float32 (N, EMBEDDING_DIMS) matrix, plus the array of names (same order).
+# Scoring is a single matrix-vector product and top-k is selected with argpartition
+#
+# add and remove update the index in place (amortized O(1), no rebuild):
+# names and matrix are views on buffers with spare capacity
+# updated returns a new index with the changes (copy on write), this one is not changed
+#
+class CentroidIndex:
+    def __init__(self, names, matrix):
+        dims = config.global_settings['EMBEDDING_DIMS']
+
+        names = np.array(names, dtype=object)
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32).reshape(len(names), dims)
+
+        # (names, matrix) are replaced together, a reader always gets a consistent pair
+        self._rows = (names, matrix)
+        self._names_buf = names
+        self._matrix_buf = matrix
+
+        self.positions = {name: i for i, name in enumerate(names)}
+
+        # serializes the writers (add, remove)
+        self.lock = threading.Lock()
+
+        # the buffers can be written (only by the last index made by updated)
+        self._owns_buffers = True
+
+    @property
+    def names(self):
+        return self._rows[0]
+
+    @property
+    def matrix(self):
+        return self._rows[1]
+
+    #
+    # build the index from the dictionary loaded from the centroids file
+    #
+    @classmethod
+    def from_dict(cls, centroids):
+        return cls(list(centroids.keys()), centroids_to_matrix(centroids))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    #
+    # distance defined on cosine similarity: dist = |1 - cos_simil|
+    # (see distance_cosine_similarity in utilities), for all the centroids
+    #
+    def distances(self, embedding, matrix=None):
+        if matrix is None:
+            matrix = self.matrix
+
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+
+        return np.abs(1. - matrix @ vec)
+
+    #
+    # return the list of the k closest speakers as pairs (name, distance)
+    # in order of increasing distance. Distance is rounded to 3 decimals
+    #
+    def search(self, embedding, k):
+        names, matrix = self._rows
+        n = len(names)
+
+        if n == 0 or k <= 0:
+            return []
+
+        dists = self.distances(embedding, matrix)
+
+        k = min(k, n)
+
+        if k < n:
+            # partial selection of the k smallest, then sort only those
+            top = np.argpartition(dists, k - 1)[:k]
+        else:
+            top = np.arange(n)
+
+        top = top[np.argsort(dists[top], kind='stable')]
+
+        return [(names[i], round(float(dists[i]), 3)) for i in top]
+
+    #
+    # search for many embeddings (B, EMBEDDING_DIMS) at once: one (B, D) x (D, N) product
+    # (in chunks of queries, to bound the memory of the (chunk, N) distances)
+    # returns a list (one per embedding) of lists of pairs (name, distance)
+    #
+    def search_batch(self, embeddings, k, max_elements=1 << 24):
+        names, matrix = self._rows
+        n = len(names)
+
+        queries = np.asarray(embeddings, dtype=np.float32).reshape(-1, matrix.shape[1])
+
+        if n == 0 or k <= 0:
+            return [[] for _ in range(len(queries))]
+
+        k = min(k, n)
+        chunk_size = max(1, max_elements // n)
+
+        results = []
+
+        for start in range(0, len(queries), chunk_size):
+            dists = np.abs(1. - queries[start:start + chunk_size] @ matrix.T)
+
+            if k < n:
+                top = np.argpartition(dists, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(n), dists.shape)
+
+            top_dists = np.take_along_axis(dists, top, axis=1)
+            order = np.argsort(top_dists, axis=1, kind='stable')
+
+            top = np.take_along_axis(top, order, axis=1)
+            top_dists = np.take_along_axis(top_dists, order, axis=1)
+
+            for row, row_dists in zip(top, top_dists):
+                results.append([(names[i], round(float(d), 3)) for i, d in zip(row, row_dists)])
+
+        return results
+
+    #
+    # add (or replace) the centroid of a speaker
+    #
+    def add(self, name, centroid):
+        dims = config.global_settings['EMBEDDING_DIMS']
+        vec = np.asarray(centroid, dtype=np.float32).reshape(dims)
+
+        with self.lock:
+            n = len(self.names)
+
+            if name in self.positions:
+                self._reserve(n)
+                self._matrix_buf[self.positions[name]] = vec
+                return
+
+            self._reserve(n + 1)
+            self._matrix_buf[n] = vec
+            self._names_buf[n] = name
+            self.positions[name] = n
+
+            self._rows = (self._names_buf[:n + 1], self._matrix_buf[:n + 1])
+
+    #
+    # a new index with the changes (name -> centroid, None to remove), for an immutable DB
+    # new speakers are appended after the rows of this index, in the same buffers (the rows
+    # seen by this index don't change): the buffers are copied only for a replace or a remove
+    #
+    def updated(self, changes):
+        with self.lock:
+            new = copy.copy(self)
+            new.positions = dict(self.positions)
+            new.lock = threading.Lock()
+
+            if not self._owns_buffers or any(name in self.positions for name in changes):
+                n = len(self.names)
+                new._names_buf = self._names_buf[:n].copy()
+                new._matrix_buf = self._matrix_buf[:n].copy()
+                new._rows = (new._names_buf, new._matrix_buf)
+
+            # the appends are done by the new index only
+            self._owns_buffers = False
+
+        for name, centroid in changes.items():
+            if centroid is None:
+                new.remove(name)
+            else:
+                new.add(name, centroid)
+
+        return new
+
+    #
+    # remove the centroid of a speaker: the last row takes its place
+    #
+    def remove(self, name):
+        with self.lock:
+            if name not in self.positions:
+                return
+
+            n = len(self.names)
+            self._reserve(n)
+
+            i = self.positions.pop(name)
+            last = n - 1
+
+            if i != last:
+                self._matrix_buf[i] = self._matrix_buf[last]
+                self._names_buf[i] = self._names_buf[last]
+                self.positions[self._names_buf[i]] = i
+
+            self._rows = (self._names_buf[:last], self._matrix_buf[:last])
+
+    #
+    # make the buffers writable (the matrix can be mapped read-only) with room for size rows
+    # capacity is doubled, so that add is amortized O(1)
+    #
+    def _reserve(self, size):
+        n = len(self.names)
+        capacity = len(self._matrix_buf)
+
+        if self._matrix_buf.flags.writeable and capacity >= size:
+            return
+
+        capacity = max(size, 2 * capacity, 16)
+
+        matrix_buf = np.empty((capacity, self._matrix_buf.shape[1]), dtype=np.float32)
+        matrix_buf[:n] = self._matrix_buf[:n]
+
+        names_buf = np.empty(capacity, dtype=object)
+        names_buf[:n] = self._names_buf[:n]
+
+        self._matrix_buf = matrix_buf
+        self._names_buf = names_buf
+        self._rows = (names_buf[:n], matrix_buf[:n])
+
+#
+# the centroids dict (name -> [[512 floats]]) as a float32 (N, EMBEDDING_DIMS) matrix
+# rows in the order of the keys
+#
+def centroids_to_matrix(centroids):
+    dims = config.global_settings['EMBEDDING_DIMS']
+
+    if len(centroids) == 0:
+        return np.empty((0, dims), dtype=np.float32)
+
+    return np.asarray(list(centroids.values()), dtype=np.float32).reshape(len(centroids), dims)
+
+#
+# the centroids dict (name -> (1, EMBEDDING_DIMS) array) as views on the matrix, no copy
+#
+def centroids_from_matrix(names, matrix):
+    return {name: matrix[i:i + 1] for i, name in enumerate(names)}
+
+#
+# Approximate index (IVF, inverted file) for very large speaker populations
+# the centroids are clustered (spherical k-means) in IVF_NLIST lists and the rows
+# are stored grouped by list. A query scores the list heads and then
+# only the rows in the IVF_NPROBE closest lists.
+# IVF_NPROBE is the recall/latency knob: IVF_NPROBE = IVF_NLIST is an exact scan
+#
+class IVFCentroidIndex(CentroidIndex):
+    def __init__(self, names, matrix, nlist=None, nprobe=None):
+        super().__init__(names, matrix)
+
+        n = len(self.names)
+
+        if nlist is None or nlist <= 0:
+            nlist = int(np.sqrt(n))
+        
+        self.nlist = max(1, min(nlist, n))
+        self.nprobe = nprobe if nprobe is not None else config.global_settings['IVF_NPROBE']
+
+        self.heads = train_ivf_heads(self.matrix, self.nlist)
+
+        # store the rows grouped by list, offsets[l]:offsets[l+1] are the rows of list l
+        assign = assign_to_heads(self.matrix, self.heads)
+        order = np.argsort(assign, kind='stable')
+
+        names = self.names[order]
+        matrix = np.ascontiguousarray(self.matrix[order])
+
+        self._rows = (names, matrix)
+        self.positions = {name: i for i, name in enumerate(names)}
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=self.nlist))))
+
+        # changes after the build: removed rows are masked, added centroids
+        # go in a small exact index, scanned at every query. Rebuilt at the next load
+        self.alive = np.ones(n, dtype=bool)
+        self.pending = CentroidIndex([], np.empty((0, matrix.shape[1]), dtype=np.float32))
+
+    def __len__(self):
+        return int(self.alive.sum()) + len(self.pending)
+
+    def __contains__(self, name):
+        return (name in self.positions and self.alive[self.positions[name]]) or name in self.pending
+
+    def search(self, embedding, k):
+        names, matrix = self._rows
+        n = len(names)
+
+        if k <= 0:
+            return []
+
+        vec = np.asarray(embedding, dtype=np.float32).reshape(-1)
+
+        nprobe = max(1, min(self.nprobe, self.nlist))
+
+        # the closest lists
+        head_scores = self.heads @ vec
+        if nprobe < self.nlist:
+            probe = np.argpartition(-head_scores, nprobe - 1)[:nprobe]
+        else:
+            probe = np.arange(self.nlist)
+
+        rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in probe])
+        rows = rows[self.alive[rows]]
+
+        results = []
+
+        if len(rows) > 0:
+            dists = np.abs(1. - matrix[rows] @ vec)
+
+            kk = min(k, len(rows))
+
+            if kk < len(rows):
+                top = np.argpartition(dists, kk - 1)[:kk]
+            else:
+                top = np.arange(len(rows))
+
+            results = [(names[rows[i]], round(float(dists[i]), 3)) for i in top]
+
+        results = results + self.pending.search(vec, k)
+
+        return sorted(results, key=lambda x: x[1])[:k]
+
+    # the lists to probe are different for every query
+    def search_batch(self, embeddings, k):
+        return [self.search(embedding, k) for embedding in embeddings]
+
+    def add(self, name, centroid):
+        with self.lock:
+            if name in self.positions:
+                self.alive[self.positions[name]] = False
+
+            self.pending.add(name, centroid)
+
+    def remove(self, name):
+        with self.lock:
+            if name in self.positions:
+                self.alive[self.positions[name]] = False
+
+            self.pending.remove(name)
+
+    # the lists are not changed: only the mask and the small index are copied
+    def updated(self, changes):
+        with self.lock:
+            new = copy.copy(self)
+            new.lock = threading.Lock()
+            new.alive = self.alive.copy()
+
+        for name in changes:
+            if name in self.positions:
+                new.alive[self.positions[name]] = False
+
+        new.pending = self.pending.updated(changes)
+
+        return new
+
+#
+# assign each row to the closest head (max cosine similarity)
+# done in chunks to bound the memory used for the (chunk, nlist) scores
+#
+def assign_to_heads(matrix, heads, chunk_size=65536):
+    assign = np.empty(len(matrix), dtype=np.int64)
+
+    for start in range(0, len(matrix), chunk_size):
+        scores = matrix[start:start + chunk_size] @ heads.T
+        assign[start:start + chunk_size] = np.argmax(scores, axis=1)
+
+    return assign
+
+#
+# spherical k-means, trained on a sample of the rows
+# (IVF_TRAIN_SAMPLES_PER_LIST rows per list are more than enough)
+#
+def train_ivf_heads(matrix, nlist, n_iter=10, seed=42):
+    rng = np.random.default_rng(seed)
+
+    n_sample = min(len(matrix), nlist * config.global_settings['IVF_TRAIN_SAMPLES_PER_LIST'])
+    sample = matrix[rng.choice(len(matrix), n_sample, replace=False)]
+
+    heads = sample[rng.choice(n_sample, nlist, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assign = assign_to_heads(sample, heads)
+
+        sums = np.zeros_like(heads)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=nlist)
+
+        # empty lists are re-seeded with a random row
+        empty = counts == 0
+        sums[empty] = sample[rng.choice(n_sample, int(empty.sum()))]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        heads = sums / np.maximum(norms, 1e-12)
+
+    return heads.astype(np.float32)
+
+#
+# build the index for the search backend selected in config
+# SEARCH_BACKEND can be: exact or ivf
+# exact is the reference; for small DB (< IVF_MIN_SPEAKERS) ivf is not worth it
+#
+def create_index(names, matrix):
+    backend = config.global_settings['SEARCH_BACKEND']
+
+    if backend == "ivf" and len(names) >= config.global_settings['IVF_MIN_SPEAKERS']:
+        return IVFCentroidIndex(names, matrix, nlist=config.global_settings['IVF_NLIST'])
+
+    return CentroidIndex(names, matrix)
+
+def create_index_from_dict(centroids):
+    exact = CentroidIndex.from_dict(centroids)
+
+    return create_index(exact.names, exact.matrix)
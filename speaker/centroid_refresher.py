@@ -0,0 +1,84 @@
+#
+# Background refresh of the centroids DB
+# a thread polls the version of the DB (mtime of the local files, ETag of the objects in Object Storage)
+# every DB_REFRESH_INTERVAL seconds: when another node (or bulk_enroll) has changed it,
+# the DB is loaded and the index built in this thread, then swapped in by the server.
+# The requests keep using the DB they have, never wait for a reload.
+# updated:  18/10/2026
+#
+import logging
+import threading
+
+# global configs
+import config
+
+from metrics import stage
+
+log = logging.getLogger("server")
+
+
+class CentroidRefresher:
+    #
+    # version_fn: a token that changes at every change of the DB
+    # reload_fn: loads the DB and swaps it in
+    # lock: serializes the reload with the changes done by this process
+    # active_fn: if given, the check is done only when it returns True (e.g. one worker per host)
+    #
+    def __init__(self, version_fn, reload_fn, lock, interval=None, name="db-refresher", active_fn=None):
+        self.name = name
+        self.active_fn = active_fn
+        self.version_fn = version_fn
+        self.reload_fn = reload_fn
+        self.lock = lock
+        self.interval = interval if interval is not None else config.global_settings['DB_REFRESH_INTERVAL']
+
+        # the version of the DB in use
+        self.version = None
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            self.version = self.version_fn()
+
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    #
+    # after a change done by this process (with the lock held): the DB in use is the current one
+    #
+    def mark_current(self):
+        self.version = self.version_fn()
+
+    #
+    # reload if the DB has changed, returns True if reloaded
+    #
+    def check(self):
+        with self.lock:
+            # read before the load: a change during the load is seen at the next check
+            version = self.version_fn()
+
+            if version == self.version:
+                return False
+
+            log.info("Centroids DB changed, reloading in background (" + self.name + ")")
+
+            with stage("reload"):
+                self.reload_fn()
+
+            self.version = version
+
+        return True
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                if self.active_fn is None or self.active_fn():
+                    self.check()
+            except Exception as e:
+                # e.g. a file being replaced, or Object Storage not reachable: retried at the next check
+                log.error("Refresh of the centroids DB failed: " + str(e))
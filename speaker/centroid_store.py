@@ -0,0 +1,557 @@
+#
+# Storage of the centroids DB: one interface (CentroidStore), pluggable backends
+#   LocalCentroidStore: files in BASE_DIR (CONFIG_TYPE = local)
+#   FsspecCentroidStore: any fsspec filesystem, Object Storage with ocifs (CONFIG_TYPE = cloud)
+#   MemoryCentroidStore: bytes in the process (tests, benchmarks)
+#
+# the DB is made of three files: current (CENTROIDS_FILE_NAME), new and backup,
+# in the format CENTROIDS_FORMAT (json or bin)
+# a backend implements only the primitives on the files:
+#   open_read: a (binary) file object, read as a stream
+#   open_write: a (binary) file object, written in chunks, visible only when closed without errors
+#   copy: dst replaced atomically (a reader sees the old or the new file, never a mix)
+#   version: changes at every write of the file (mtime, ETag, counter)
+# and on the logs (the enrollment log):
+#   append: data added at the end of the log, durable when it returns
+#   list: the parts of the log (the file, or one object per append), in the order of the appends
+#   lock: serializes the appends and the rewrite of a part between processes
+# load, write_new, publish (swap) and restore are written once here, on top of them
+# next to every file its metadata (file name + META_SUFFIX): the settings used to enroll the speakers
+# updated:  18/10/2026
+#
+import io
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import socket
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+
+# global configs
+import config
+
+from centroids_bin import load_centroids_bin, load_centroids_bin_from_fp, write_centroids_bin, read_header
+from centroid_index import centroids_to_matrix, centroids_from_matrix
+from utilities import centroids_file_name, is_bin_format, check_centroids_file, check_centroids_matrix
+from utilities import NumpyArrayEncoder, oss_filesystem, object_version
+
+log = logging.getLogger("server")
+
+# the files of the DB (keys in config)
+CUR = 'CENTROIDS_FILE_NAME'
+NEW = 'NEW_CENTROIDS_FILE_NAME'
+BCK = 'BCK_CENTROIDS_FILE_NAME'
+
+# size of the chunks of a copy done through the service, and of a write
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+# every file of the DB has a metadata file: the settings used to compute the centroids
+META_SUFFIX = ".meta.json"
+
+# a DB without metadata was enrolled with the original features
+LEGACY_FEATURES = {"VAD_MODE": "percentile"}
+
+#
+# the settings that change the centroids (an enrolled DB is valid only with the same)
+#
+def features_settings():
+    settings = {key: config.global_settings[key] for key in ('MODEL_FILE', 'VAD_MODE')}
+
+    if settings['VAD_MODE'] == "energy":
+        for key in ('VAD_DYNAMIC_RANGE_DB', 'VAD_FLOOR_DB', 'VAD_HANGOVER_FRAMES'):
+            settings[key] = config.global_settings[key]
+
+    return settings
+
+#
+# the settings of the DB different from the ones of the service: name -> (DB, service)
+#
+def features_mismatch(features):
+    current = features_settings()
+
+    return {key: (value, current.get(key)) for key, value in features.items() if current.get(key) != value}
+
+#
+# the json file (same content of json.dump), written in chunks of COPY_CHUNK_SIZE to the binary fp
+# every entry is encoded with the C encoder (json.dump to a file uses the Python one, 2-3x slower)
+#
+def write_centroids_json(fp, centroids):
+    chunk = ["{"]
+    size = 1
+
+    for i, (name, centroid) in enumerate(centroids.items()):
+        entry = (", " if i > 0 else "") + json.dumps(name) + ": " + json.dumps(centroid, cls=NumpyArrayEncoder)
+        chunk.append(entry)
+        size += len(entry)
+
+        if size >= COPY_CHUNK_SIZE:
+            fp.write("".join(chunk).encode('utf-8'))
+            chunk = []
+            size = 0
+
+    chunk.append("}")
+    fp.write("".join(chunk).encode('utf-8'))
+
+
+class CentroidStore:
+    name = "store"
+
+    def __init__(self):
+        # file name -> (version, centroids) of the last load: an unchanged file is not read again
+        self.loaded = {}
+
+        # settings of the DB different from the ones of the service, found at the last load
+        self.mismatch = {}
+
+    #
+    # primitives, implemented by the backends
+    #
+    def open_read(self, fname):
+        raise NotImplementedError
+
+    def open_write(self, fname):
+        raise NotImplementedError
+
+    def copy(self, src, dst):
+        raise NotImplementedError
+
+    def version(self, fname):
+        raise NotImplementedError
+
+    def exists(self, fname):
+        raise NotImplementedError
+
+    def remove(self, fname):
+        raise NotImplementedError
+
+    # returns the part written
+    def append(self, fname, data):
+        raise NotImplementedError
+
+    # list of (part, version), a part is read with open_read and removed with remove
+    def list(self, fname):
+        raise NotImplementedError
+
+    # the parts are never changed by an append: nothing to serialize
+    def lock(self, fname):
+        return nullcontext()
+
+    # header, names and matrix of a file in bin format
+    def read_bin(self, fname, verify=None):
+        with self.open_read(fname) as fp:
+            return load_centroids_bin_from_fp(fp, verify)
+
+    #
+    # the DB in file key (CUR, NEW or BCK) as a dict name -> centroid
+    #
+    def load(self, key=CUR):
+        fname = centroids_file_name(key)
+
+        version = self.version(fname)
+        cached = self.loaded.get(fname)
+
+        if cached is not None and cached[0] == version:
+            log.info("Centroids file " + fname + " not changed, not read again")
+
+            # a copy: the caller can change the dict
+            return dict(cached[1])
+
+        log.info("Loading centroids file " + fname + " from " + self.name)
+
+        self.check_features(fname)
+
+        if is_bin_format():
+            _, names, matrix = self.read_bin(fname)
+
+            log.info("Checking centroids file")
+            check_centroids_matrix(matrix)
+
+            new_centroids = centroids_from_matrix(names, matrix)
+        else:
+            with self.open_read(fname) as fp:
+                new_centroids = json.load(fp)
+
+            log.info("Checking centroids file")
+            check_centroids_file(new_centroids)
+
+        self.loaded[fname] = (version, new_centroids)
+
+        return dict(new_centroids)
+
+    #
+    # the metadata of a file of the DB, {} if there are none
+    #
+    def read_meta(self, fname):
+        if not self.exists(fname + META_SUFFIX):
+            return {}
+
+        with self.open_read(fname + META_SUFFIX) as fp:
+            return json.load(fp)
+
+    def write_meta(self, fname, meta):
+        with self.open_write(fname + META_SUFFIX) as fp:
+            fp.write(json.dumps(meta).encode('utf-8'))
+
+    #
+    # centroids computed with other settings (e.g. VAD_MODE) give wrong distances:
+    # reported, the speakers have to be enrolled again
+    #
+    def check_features(self, fname):
+        features = self.read_meta(fname).get("features", LEGACY_FEATURES)
+
+        self.mismatch = features_mismatch(features)
+
+        for key, (db_value, value) in self.mismatch.items():
+            log.error("Centroids DB " + fname + " enrolled with " + key + " = " + str(db_value) +
+                      ", the service uses " + str(value) + ": the speakers must be enrolled again")
+
+    # changes at every write of the current file (publish, restore), also by another process
+    def current_version(self):
+        return self.version(centroids_file_name(CUR))
+
+    #
+    # the version of the snapshot in file key: in its metadata (or in the header of a bin file
+    # written without), 0 if there is no DB
+    #
+    def db_version(self, key=CUR):
+        fname = centroids_file_name(key)
+
+        meta = self.read_meta(fname)
+
+        if "version" in meta:
+            return meta["version"]
+
+        if not is_bin_format() or not self.exists(fname):
+            return 0
+
+        with self.open_read(fname) as fp:
+            return read_header(fp).version
+
+    #
+    # write new_centroids as the new file (not used until publish), returns its version
+    #
+    def write_new(self, new_centroids):
+        fname = centroids_file_name(NEW)
+
+        log.info("Writing new centroids to " + self.name)
+
+        check_centroids_file(new_centroids)
+
+        # after the current and the backup one (a restored DB has the version of the backup)
+        version = max(self.db_version(CUR), self.db_version(BCK)) + 1
+
+        if is_bin_format():
+            with self.open_write(fname) as fp:
+                write_centroids_bin(fp, list(new_centroids.keys()), centroids_to_matrix(new_centroids), version)
+        else:
+            with self.open_write(fname) as fp:
+                write_centroids_json(fp, new_centroids)
+
+        self.write_meta(fname, {"features": features_settings(), "version": version})
+
+        return version
+
+    #
+    # the new file becomes the current one, the current one the backup
+    #
+    def publish(self):
+        CUR_FILE = centroids_file_name(CUR)
+
+        # the checksum is verified once here (not at every load, see CENTROIDS_VERIFY_CHECKSUM)
+        if is_bin_format():
+            log.info("Verifying the checksum of NEW")
+            self.read_bin(centroids_file_name(NEW), verify=True)
+
+        if self.exists(CUR_FILE):
+            log.info("backup CUR as BCK")
+            self.copy_with_meta(CUR_FILE, centroids_file_name(BCK))
+
+        log.info("copy NEW as CUR")
+        self.copy_with_meta(centroids_file_name(NEW), CUR_FILE)
+
+    def restore(self):
+        log.info("restore BCK as CUR")
+        self.copy_with_meta(centroids_file_name(BCK), centroids_file_name(CUR))
+
+    # the file and its metadata (a legacy file without metadata leaves dst without)
+    def copy_with_meta(self, src, dst):
+        self.copy(src, dst)
+
+        if self.exists(src + META_SUFFIX):
+            self.copy(src + META_SUFFIX, dst + META_SUFFIX)
+        elif self.exists(dst + META_SUFFIX):
+            self.remove(dst + META_SUFFIX)
+
+
+#
+# files in a local dir (BASE_DIR)
+#
+class LocalCentroidStore(CentroidStore):
+    name = "local"
+
+    def __init__(self, base_dir=None):
+        super().__init__()
+        self.base_dir = base_dir if base_dir is not None else config.global_settings['BASE_DIR']
+
+    def path(self, fname):
+        return self.base_dir + "/" + fname
+
+    def open_read(self, fname):
+        return open(self.path(fname), 'rb')
+
+    #
+    # written to a temp file, renamed on close: a reader never sees a partial file
+    # and a current file mapped in memory (bin format) is not overwritten in place
+    #
+    @contextmanager
+    def open_write(self, fname):
+        tmp = self.path(fname) + ".tmp"
+
+        try:
+            with open(tmp, 'wb') as fp:
+                yield fp
+
+                fp.flush()
+                os.fsync(fp.fileno())
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        os.replace(tmp, self.path(fname))
+
+    def copy(self, src, dst):
+        tmp = self.path(dst) + ".tmp"
+
+        shutil.copyfile(self.path(src), tmp)
+        os.replace(tmp, self.path(dst))
+
+    def version(self, fname):
+        st = os.stat(self.path(fname))
+
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def exists(self, fname):
+        return os.path.exists(self.path(fname))
+
+    def remove(self, fname):
+        os.remove(self.path(fname))
+
+    # the log is a single file, appended in place
+    def append(self, fname, data):
+        with self.lock(fname):
+            with open(self.path(fname), 'ab') as fp:
+                fp.write(data)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+        return fname
+
+    def list(self, fname):
+        try:
+            return [(fname, self.version(fname))]
+        except FileNotFoundError:
+            return []
+
+    # the file is not replaced (rewrite of the log) during an append
+    @contextmanager
+    def lock(self, fname):
+        with open(self.path(fname + ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # the matrix is mapped, the dict has views on it
+    def read_bin(self, fname, verify=None):
+        return load_centroids_bin(self.path(fname), verify)
+
+
+#
+# any fsspec filesystem under prefix, by default Object Storage (oss_filesystem, BUCKET_PREFIX)
+# the filesystem is taken at every call: set_oss_filesystem can replace it (tests)
+#
+class FsspecCentroidStore(CentroidStore):
+    name = "Object Storage"
+
+    def __init__(self, fs=None, prefix=None):
+        super().__init__()
+        self._fs = fs
+        self.prefix = prefix if prefix is not None else config.global_settings['BUCKET_PREFIX']
+
+    @property
+    def fs(self):
+        return self._fs if self._fs is not None else oss_filesystem()
+
+    def path(self, fname):
+        return self.prefix + fname
+
+    def open_read(self, fname):
+        return self.fs.open(self.path(fname), 'rb')
+
+    # in Object Storage the object is created when the upload (in parts) is completed, on close
+    @contextmanager
+    def open_write(self, fname):
+        with self.fs.open(self.path(fname), mode="wb") as fp:
+            yield fp
+
+    #
+    # server side copy (the content doesn't pass through the service)
+    # in chunks if the filesystem has no copy (any format, no parsing)
+    #
+    def copy(self, src, dst):
+        fs = self.fs
+        src = self.path(src)
+        dst = self.path(dst)
+
+        old_version = object_version(fs, dst) if fs.exists(dst) else None
+
+        try:
+            fs.copy(src, dst)
+        except NotImplementedError:
+            with fs.open(src, 'rb') as fp_src, fs.open(dst, mode="wb") as fp_dst:
+                shutil.copyfileobj(fp_src, fp_dst, COPY_CHUNK_SIZE)
+            return
+
+        self.wait_for_copy(fs, dst, old_version)
+
+    #
+    # in Object Storage the copy is completed asynchronously:
+    # wait until dst is the new object (its version has changed)
+    #
+    def wait_for_copy(self, fs, dst, old_version):
+        deadline = time.time() + config.global_settings['OSS_COPY_TIMEOUT']
+
+        while True:
+            fs.invalidate_cache(dst)
+
+            if fs.exists(dst) and object_version(fs, dst) != old_version:
+                return
+
+            if time.time() > deadline:
+                raise TimeoutError("Copy to " + dst + " not completed")
+
+            time.sleep(0.2)
+
+    # with the filesystem: a load from another filesystem (set_oss_filesystem) is not taken from the cache
+    def version(self, fname):
+        fs = self.fs
+
+        # the info of the object, not the one in the cache of the filesystem
+        fs.invalidate_cache(self.path(fname))
+
+        return (id(fs), object_version(fs, self.path(fname)))
+
+    def exists(self, fname):
+        return self.fs.exists(self.path(fname))
+
+    def remove(self, fname):
+        self.fs.rm(self.path(fname))
+
+    #
+    # Object Storage has no append: one small object per append under fname + "/"
+    # named by time, node, pid and a random part: unique between nodes and processes,
+    # sorted by name they are in the order of the appends
+    #
+    def append(self, fname, data):
+        # zero padded time first: lexicographic order is the order of the appends
+        part = fname + "/%020d-%s-%d-%s" % (time.time_ns(), socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        with self.fs.open(self.path(part), mode="wb") as fp:
+            fp.write(data)
+
+        return part
+
+    def list(self, fname):
+        fs = self.fs
+        prefix = self.path(fname) + "/"
+
+        # the objects appended by the other nodes, not the listing in the cache of the filesystem
+        fs.invalidate_cache(prefix)
+
+        try:
+            entries = fs.ls(prefix, detail=True)
+        except FileNotFoundError:
+            return []
+
+        # by name: the listing can return the paths without the protocol
+        parts = [(fname + "/" + os.path.basename(entry["name"]), entry.get("etag", entry.get("size")))
+                 for entry in entries]
+
+        return sorted(parts)
+
+
+#
+# the files as bytes in memory
+#
+class MemoryCentroidStore(CentroidStore):
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+
+        # file name -> (version, content)
+        self.files = {}
+        self.counter = 0
+        self.files_lock = threading.Lock()
+
+    def _set(self, fname, content):
+        with self.files_lock:
+            self.counter += 1
+            self.files[fname] = (self.counter, content)
+
+    def _get(self, fname):
+        try:
+            return self.files[fname]
+        except KeyError:
+            raise FileNotFoundError(fname)
+
+    def open_read(self, fname):
+        return io.BytesIO(self._get(fname)[1])
+
+    @contextmanager
+    def open_write(self, fname):
+        buf = io.BytesIO()
+        yield buf
+
+        self._set(fname, buf.getvalue())
+
+    def copy(self, src, dst):
+        self._set(dst, self._get(src)[1])
+
+    def version(self, fname):
+        return self._get(fname)[0]
+
+    def exists(self, fname):
+        return fname in self.files
+
+    def remove(self, fname):
+        with self.files_lock:
+            self.files.pop(fname, None)
+
+    # one part per append, as in Object Storage
+    def append(self, fname, data):
+        part = fname + "/%020d-%s" % (time.time_ns(), uuid.uuid4().hex[:8])
+        self._set(part, data)
+
+        return part
+
+    def list(self, fname):
+        with self.files_lock:
+            return sorted((part, version) for part, (version, _) in self.files.items()
+                          if part.startswith(fname + "/"))
+
+
+#
+# the store for CONFIG_TYPE
+#
+def create_store():
+    if config.global_settings['CONFIG_TYPE'] == "local":
+        return LocalCentroidStore()
+
+    return FsspecCentroidStore()
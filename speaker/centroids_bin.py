@@ -0,0 +1,160 @@
+#
+# Binary format for the centroids DB (CENTROIDS_FORMAT = "bin")
+# replaces the json file (lists of 512 floats as text): loads almost instantly with np.memmap
+#
+# layout of the file:
+#   header (HEADER_SIZE bytes): magic, format version, dims, count, DB version,
+#                               offset and size of the names table, crc32
+#   matrix: float32 (count, dims), C order, at offset HEADER_SIZE
+#   names table: json list of the speakers' names (utf-8), in the order of the rows
+#
+# usage (converters, for backward compatibility with the json format):
+#   python centroids_bin.py to-bin centroids_data_structure.json centroids_data_structure.bin
+#   python centroids_bin.py to-json centroids_data_structure.bin centroids_data_structure.json
+#
+import io
+import sys
+import json
+import zlib
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# global configs
+import config
+
+from centroid_index import centroids_to_matrix, centroids_from_matrix
+
+MAGIC = b'SPKC'
+FORMAT_VERSION = 1
+
+# magic, format version, dims, count, DB version, names offset, names size, crc32
+HEADER_FORMAT = '<4sIIQQQQI'
+HEADER_SIZE = 64
+
+# the matrix is written in chunks (a large DB is not copied again in the buffers of the file object)
+WRITE_CHUNK_SIZE = 4 * 1024 * 1024
+
+Header = namedtuple('Header', ['magic', 'format_version', 'dims', 'count', 'version',
+                               'names_offset', 'names_size', 'checksum'])
+
+
+def read_header(fp):
+    buf = fp.read(HEADER_SIZE)
+
+    if len(buf) < HEADER_SIZE:
+        raise ValueError("Invalid centroids file: truncated header")
+
+    header = Header(*struct.unpack_from(HEADER_FORMAT, buf))
+
+    if header.magic != MAGIC:
+        raise ValueError("Invalid centroids file: bad magic")
+    if header.format_version != FORMAT_VERSION:
+        raise ValueError("Unsupported centroids file format version: " + str(header.format_version))
+
+    return header
+
+#
+# write names and matrix (N, dims) to the (binary) file object fp
+#
+def write_centroids_bin(fp, names, matrix, version=0):
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    count, dims = matrix.shape
+
+    names_bytes = json.dumps(list(names)).encode('utf-8')
+
+    checksum = zlib.crc32(names_bytes, zlib.crc32(memoryview(matrix).cast('B')))
+
+    header = struct.pack(HEADER_FORMAT, MAGIC, FORMAT_VERSION, dims, count, version,
+                         HEADER_SIZE + matrix.nbytes, len(names_bytes), checksum)
+
+    fp.write(header.ljust(HEADER_SIZE, b'\0'))
+
+    data = memoryview(matrix).cast('B')
+    for start in range(0, len(data), WRITE_CHUNK_SIZE):
+        fp.write(data[start:start + WRITE_CHUNK_SIZE])
+
+    fp.write(names_bytes)
+
+def verify_checksum(header, matrix, names_bytes):
+    checksum = zlib.crc32(names_bytes, zlib.crc32(memoryview(np.ascontiguousarray(matrix)).cast('B')))
+
+    if checksum != header.checksum:
+        raise ValueError("Invalid centroids file: bad checksum")
+
+#
+# local file: the matrix is mapped (read-only), not read
+# returns header, names and the (count, dims) matrix
+#
+def load_centroids_bin(path, verify=None):
+    if verify is None:
+        verify = config.global_settings['CENTROIDS_VERIFY_CHECKSUM']
+
+    with open(path, 'rb') as fp:
+        header = read_header(fp)
+
+        fp.seek(header.names_offset)
+        names_bytes = fp.read(header.names_size)
+
+    if header.count > 0:
+        matrix = np.memmap(path, dtype=np.float32, mode='r', offset=HEADER_SIZE,
+                           shape=(header.count, header.dims))
+    else:
+        matrix = np.empty((0, header.dims), dtype=np.float32)
+
+    if verify:
+        verify_checksum(header, matrix, names_bytes)
+
+    return header, json.loads(names_bytes.decode('utf-8')), matrix
+
+#
+# any file object (e.g. from ocifs), read in memory: no copy after the read
+#
+def load_centroids_bin_from_fp(fp, verify=None):
+    if verify is None:
+        verify = config.global_settings['CENTROIDS_VERIFY_CHECKSUM']
+
+    buf = fp.read()
+    header = read_header(io.BytesIO(buf[:HEADER_SIZE]))
+
+    matrix = np.frombuffer(buf, dtype=np.float32, count=header.count * header.dims,
+                           offset=HEADER_SIZE).reshape(header.count, header.dims)
+    names_bytes = buf[header.names_offset:header.names_offset + header.names_size]
+
+    if verify:
+        verify_checksum(header, matrix, names_bytes)
+
+    return header, json.loads(names_bytes.decode('utf-8')), matrix
+
+#
+# converters from/to the json format
+#
+def json_to_bin(json_path, bin_path, version=0):
+    with open(json_path, 'r') as fp:
+        centroids = json.load(fp)
+
+    with open(bin_path, 'wb') as fp:
+        write_centroids_bin(fp, list(centroids.keys()), centroids_to_matrix(centroids), version)
+
+def bin_to_json(bin_path, json_path):
+    _, names, matrix = load_centroids_bin(bin_path)
+
+    # same structure of the json file: name -> [[512 floats]]
+    centroids = {name: row.tolist() for name, row in centroids_from_matrix(names, matrix).items()}
+
+    with open(json_path, 'w') as fp:
+        json.dump(centroids, fp)
+
+#
+# Main
+#
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] not in ("to-bin", "to-json"):
+        print("usage: python centroids_bin.py to-bin|to-json input_file output_file")
+        sys.exit(1)
+
+    if sys.argv[1] == "to-bin":
+        json_to_bin(sys.argv[2], sys.argv[3])
+    else:
+        bin_to_json(sys.argv[2], sys.argv[3])
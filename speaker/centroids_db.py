@@ -0,0 +1,132 @@
+#
+# The centroids DB in memory as immutable, versioned snapshots
+# a request takes the current snapshot (a single reference, no lock) and uses it until it ends:
+# a change makes a new snapshot (copy on write), the old one is never modified.
+#
+# The changes (add, delete of speakers) go through a single mutation queue: one writer thread
+# collects the changes for up to MUTATION_WINDOW_MS (or MUTATION_MAX_SIZE changes)
+# and applies them together: one write to the enrollment log, one new snapshot
+# updated:  18/10/2026
+#
+import logging
+import queue
+import threading
+import time
+from types import MappingProxyType
+from concurrent.futures import Future
+
+# global configs
+import config
+
+from executors import Overloaded
+from metrics import stage, QUEUE_DEPTH
+
+log = logging.getLogger("server")
+
+#
+# the version of the DB: "<version of the snapshot>.<changes of the enrollment log applied on it>"
+# both from the persisted state: the same in all the workers and nodes with the same DB, kept at restart
+#
+def format_version(snapshot_version, num_changes):
+    return "%d.%d" % (snapshot_version, num_changes)
+
+def next_version(version, num_changes):
+    snapshot_version, applied = version.split(".")
+
+    return format_version(int(snapshot_version), int(applied) + num_changes)
+
+
+class Snapshot:
+    def __init__(self, version, centroids, index):
+        self.version = version
+
+        # read-only view: the dict can't be changed through the snapshot
+        self.centroids = MappingProxyType(centroids)
+        self.index = index
+
+    #
+    # a new snapshot with the changes (name -> centroid, None to remove)
+    #
+    def updated(self, changes, version=None):
+        new_centroids = dict(self.centroids)
+
+        for name, centroid in changes.items():
+            if centroid is None:
+                new_centroids.pop(name, None)
+            else:
+                new_centroids[name] = centroid
+
+        if version is None:
+            version = next_version(self.version, len(changes))
+
+        return Snapshot(version, new_centroids, self.index.updated(changes))
+
+
+#
+# apply_fn(changes) is called in the writer thread with a list of (op, name, centroid)
+# in the order received, its result (the version of the DB) is returned to all the callers
+#
+class MutationQueue:
+    def __init__(self, apply_fn, window_ms=None, max_size=None, max_pending=None):
+        self.apply_fn = apply_fn
+        self.window = (window_ms if window_ms is not None else config.global_settings['MUTATION_WINDOW_MS']) / 1000.
+        self.max_size = max_size if max_size is not None else config.global_settings['MUTATION_MAX_SIZE']
+        self.max_pending = max_pending if max_pending is not None else config.global_settings['MUTATION_MAX_PENDING']
+
+        self.requests = queue.Queue()
+
+        QUEUE_DEPTH.labels("mutations").set_function(self.requests.qsize)
+
+        self.worker = threading.Thread(target=self._run, name="mutation-queue", daemon=True)
+        self.worker.start()
+
+    #
+    # returns a Future with the version of the DB with the change
+    # raises Overloaded if too many changes are waiting
+    #
+    def submit(self, op, name, centroid=None):
+        if self.requests.qsize() >= self.max_pending:
+            log.warning("Mutation queue is full, request rejected")
+            raise Overloaded("mutations")
+
+        future = Future()
+        self.requests.put(((op, name, centroid), future))
+
+        return future
+
+    #
+    # collect changes until the window expires or the group is full
+    #
+    def _collect(self):
+        pending = [self.requests.get()]
+
+        deadline = time.monotonic() + self.window
+
+        while len(pending) < self.max_size:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+            try:
+                pending.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+
+            try:
+                with stage("mutation"):
+                    version = self.apply_fn([change for change, _ in pending])
+            except Exception as e:
+                log.error("Change of the centroids DB failed: " + str(e))
+
+                for _, future in pending:
+                    future.set_exception(e)
+                continue
+
+            for _, future in pending:
+                future.set_result(version)
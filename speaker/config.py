@@ -24,6 +24,8 @@ global_settings = dict(
 
     # bucket containing all the files from the model
     BUCKET_PREFIX = "oci://audio_db@frfbyzohecdc/",
+    # max time (sec.) to wait for a server side copy in Object Storage (swap, restore)
+    OSS_COPY_TIMEOUT = 60,
     # dir containin all py and model files
     BASE_DIR = "/Users/lsaetta/Progetti/speaker",
     
@@ -36,21 +38,136 @@ global_settings = dict(
     PORT = 8888,
     # IP
     IP = "0.0.0.0",
+    # number of worker processes serving requests. With more than one worker
+    # the centroids DB is shared (read-only mapped) between them, in SHARED_DB_DIR
+    NUM_WORKERS = 1,
+    SHARED_DB_DIR = "/dev/shm/speaker_db",
+    # interval (sec.) of the check, in every worker, for a new version of the shared DB (swapped in background)
+    SHARED_DB_POLL_INTERVAL = 0.2,
 
     # the name of the file with all pairs name:embedding-vec
     CENTROIDS_FILE_NAME = "centroids_data_structure.json",
     # the new file, with speaker added
     NEW_CENTROIDS_FILE_NAME = "new_centroids_data_structure.json",
     BCK_CENTROIDS_FILE_NAME = "centroids_data_structure.json.bck",
+    # log of the changes (add, delete) after the last snapshot (the centroids file)
+    ENROLLMENT_LOG_FILE_NAME = "centroids_log.jsonl",
+    # number of changes after which the log is compacted in a new centroids file
+    ENROLLMENT_LOG_COMPACT_EVERY = 100,
+    # interval (sec.) of the check for changes of the DB done by other nodes (reloaded in background)
+    # 0: no check, the DB is reloaded only with /reload
+    DB_REFRESH_INTERVAL = 5,
+    # format of the centroids files: json or bin (binary, mapped in memory: fast load)
+    # with bin the files names above are used with .bin in place of .json
+    # convert with: python centroids_bin.py to-bin|to-json input_file output_file
+    CENTROIDS_FORMAT = "json",
+    # bin: verify the checksum also at every load (reads all the mapped matrix: slow for a large DB)
+    # the new file is always verified before it is published
+    CENTROIDS_VERIFY_CHECKSUM = False,
     
     # Keras model file name
     MODEL_FILE = 'model.h5',
     # length of the embedding vector
     EMBEDDING_DIMS = 512,
     
+    # micro-batching of concurrent requests in a single forward pass of the model
+    BATCHING_ENABLED = True,
+    # max time (ms) a request waits for others to fill the batch
+    BATCH_WINDOW_MS = 5,
+    # max number of items in a batch
+    BATCH_MAX_SIZE = 32,
+
+    # how the embedding of a clip is computed (identify, verify):
+    # single: one window of NUM_FRAMES frames
+    # multi: average of the embeddings of overlapping windows covering all the clip
+    EMBEDDING_MODE = "single",
+    # single: how the window is chosen (can be changed for a request)
+    # center and seeded are deterministic: the same audio gives always the same embedding
+    # random: a random window (as in the original code)
+    CROP_POLICY = "center",
+    # seeded: the seed, combined with the content of the audio
+    CROP_SEED = 42,
+    # multi: a window every MULTI_WINDOW_STRIDE frames (10 ms each)
+    MULTI_WINDOW_STRIDE = 80,
+    # multi: max number of windows (evenly spaced), bounds the latency for long clips
+    MULTI_WINDOW_MAX = 16,
+
+    # cache of the embeddings of the clips (identify, verify), keyed by the hash of the audio
+    # not used with CROP_POLICY = random
+    EMBEDDING_CACHE_ENABLED = True,
+    # max memory used by the cache
+    EMBEDDING_CACHE_MAX_BYTES = 64 * 1024 * 1024,
+    # time to live of an entry, in seconds
+    EMBEDDING_CACHE_TTL = 3600,
+    # dir for the (optional) disk tier of the cache, empty: disabled
+    EMBEDDING_CACHE_DIR = "",
+
+    # silence removal before the features
+    # percentile: the original trim (first to last sample above the 95 percentile)
+    # energy: frame level energy VAD (non speech frames are dropped), none: no removal
+    # the centroids must be enrolled with the same mode used for identify: to switch, re-enroll all
+    # the speakers (the mode is saved with the DB, a mismatch is reported at load)
+    VAD_MODE = "percentile",
+    # energy: a frame (10 ms) is speech if within VAD_DYNAMIC_RANGE_DB of the loudest frame...
+    VAD_DYNAMIC_RANGE_DB = 40,
+    # ...and above VAD_FLOOR_DB (dB full scale)
+    VAD_FLOOR_DB = -60,
+    # energy: frames kept before and after speech
+    VAD_HANGOVER_FRAMES = 10,
+
+    # max batch size used to embed many windows together (e.g. segments in add_speaker)
+    EMBEDDING_BATCH_SIZE = 64,
+
+    # streaming identification (websocket /identify_stream)
+    # a window (NUM_FRAMES frames) is embedded every STREAM_WINDOW_STRIDE frames (10 ms each)
+    STREAM_WINDOW_STRIDE = 80,
+    # a provisional result is sent every STREAM_EMIT_EVERY_FRAMES frames
+    STREAM_EMIT_EVERY_FRAMES = 100,
+
+    # identify_batch: max number of clips in a request
+    IDENTIFY_BATCH_MAX_CLIPS = 1000,
+    # identify_batch: max size (bytes, uncompressed) of a clip, sent as a file or in the archive...
+    IDENTIFY_BATCH_MAX_CLIP_BYTES = 20 * 1024 * 1024,
+    # ...and of all the clips (files and archive together, also the archive as uploaded)
+    IDENTIFY_BATCH_MAX_BYTES = 500 * 1024 * 1024,
+
+    # stages of a request, each one with its executor (see executors.py)
+    # and a max number of jobs in flight: when full, the request gets 429 (Too Many Requests)
+    # features (decode, VAD, filter banks): processes
+    FEATURE_WORKERS = 4,
+    FEATURE_MAX_PENDING = 64,
+    # model (inference and scoring): threads, the BatchingEngine groups their requests
+    MODEL_WORKERS = 8,
+    MODEL_MAX_PENDING = 64,
+    # storage (I/O on the centroids DB and enrollment log): 1 keeps the changes serialized
+    STORAGE_WORKERS = 1,
+    STORAGE_MAX_PENDING = 16,
+    # disk tier of the embedding cache (EMBEDDING_CACHE_DIR): threads, when full the tier is skipped
+    CACHE_WORKERS = 2,
+    CACHE_MAX_PENDING = 32,
+    # changes of the DB (add, delete) collected for up to MUTATION_WINDOW_MS (or MUTATION_MAX_SIZE changes)
+    # and applied together: one write to the enrollment log, one new snapshot of the DB
+    MUTATION_WINDOW_MS = 10,
+    MUTATION_MAX_SIZE = 64,
+    # max changes waiting, then 429
+    MUTATION_MAX_PENDING = 256,
+
     # used by verify: compare name with the name of the first NUM_CANDIDATES 
     NUM_CANDIDATES = 2,
 
+    # search backend used to score against the centroids: exact or ivf
+    # exact scans all the centroids, ivf is approximate (for very large DB)
+    SEARCH_BACKEND = "exact",
+    # ivf: number of lists (clusters), 0 means sqrt(number of speakers)
+    IVF_NLIST = 0,
+    # ivf: number of lists scanned for each query. The recall/latency knob:
+    # higher is more accurate and slower
+    IVF_NPROBE = 8,
+    # ivf: below this number of speakers the exact scan is used
+    IVF_MIN_SPEAKERS = 10000,
+    # ivf: rows sampled per list for training the clusters
+    IVF_TRAIN_SAMPLES_PER_LIST = 64,
+
     # description used by FastAPI
     TITLE = "Speaker Recognition Service",
 
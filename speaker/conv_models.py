@@ -2,6 +2,7 @@ import logging
 import os
 
 import numpy as np
+import tensorflow as tf
 import tensorflow.keras.backend as K
 from tensorflow.keras import layers
 from tensorflow.keras import regularizers
@@ -67,9 +68,25 @@ class DeepSpeakerModel:
             x = Lambda(lambda y: K.l2_normalize(y, axis=1), name='ln')(x)
         self.m = Model(inputs, x, name='ResCNN')
 
+        # inference graph, traced once for any batch size (no Keras predict loop per call)
+        self._embed_fn = tf.function(self._forward,
+                                     input_signature=[tf.TensorSpec(shape=batch_input_shape, dtype=tf.float32)])
+
     def keras_model(self):
         return self.m
 
+    def _forward(self, x):
+        return self.m(x, training=False)
+
+    # inference entry point: batch has shape (B, NUM_FRAMES, NUM_FBANKS, 1)
+    def embed(self, batch):
+        return self._embed_fn(tf.convert_to_tensor(batch, dtype=tf.float32)).numpy()
+
+    # trace the inference graph, so that the first real request doesn't pay for it
+    def warm_up(self):
+        batch_input_shape = self._embed_fn.input_signature[0].shape
+        self.embed(np.zeros([1] + batch_input_shape.as_list()[1:], dtype=np.float32))
+
     def get_weights(self):
         w = self.m.get_weights()
         if self.include_softmax:
@@ -0,0 +1,192 @@
+#
+# Cache of the embeddings, keyed by the hash of the uploaded bytes
+# (plus model and features config): a clip submitted again to identify or verify
+# doesn't pay again decode, filter banks and model.
+# LRU in memory, bounded in size (EMBEDDING_CACHE_MAX_BYTES), with a TTL.
+# Optionally a second tier on local disk (EMBEDDING_CACHE_DIR): lookup and put_memory only touch
+# the memory, get_disk and put_disk do the I/O (the server runs them in the storage threads).
+# Valid only with a deterministic embedding (see CROP_POLICY), else it is bypassed
+# updated:  18/10/2026
+#
+import os
+import time
+import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# global configs
+import config
+
+log = logging.getLogger("server")
+
+# to be changed when the features computation changes (the old entries become invalid)
+FEATURES_VERSION = "1"
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes=None, ttl=None, disk_dir=None):
+        self.max_bytes = max_bytes if max_bytes is not None else config.global_settings['EMBEDDING_CACHE_MAX_BYTES']
+        self.ttl = ttl if ttl is not None else config.global_settings['EMBEDDING_CACHE_TTL']
+        self.disk_dir = disk_dir if disk_dir is not None else config.global_settings['EMBEDDING_CACHE_DIR']
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+        # key -> (expiration time, embedding), in LRU order
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    #
+    # the key: hash of the bytes and of everything that changes the embedding
+    #
+    def key(self, file, mode, crop):
+        h = hashlib.blake2b(file, digest_size=16)
+
+        settings = (config.global_settings['MODEL_FILE'], FEATURES_VERSION, mode, crop,
+                    config.global_settings['MULTI_WINDOW_STRIDE'], config.global_settings['MULTI_WINDOW_MAX'],
+                    config.global_settings['CROP_SEED'], config.global_settings['VAD_MODE'],
+                    config.global_settings['VAD_DYNAMIC_RANGE_DB'], config.global_settings['VAD_FLOOR_DB'],
+                    config.global_settings['VAD_HANGOVER_FRAMES'])
+        h.update(repr(settings).encode('utf-8'))
+
+        return h.hexdigest()
+
+    #
+    # returns (key, embedding) from the memory tier: embedding is None if not there
+    # (to be looked up with get_disk, or computed and put with key)
+    # key is None if the embedding can't be cached
+    #
+    def lookup(self, file, mode, crop):
+        if mode is None:
+            mode = config.global_settings['EMBEDDING_MODE']
+        if crop is None:
+            crop = config.global_settings['CROP_POLICY']
+
+        # a random crop gives a different embedding every time
+        if mode == "single" and crop == "random":
+            self._count("bypassed")
+            return None, None
+
+        key = self.key(file, mode, crop)
+
+        embedding = self.get_memory(key)
+
+        if embedding is None and not self.disk_dir:
+            self._count("misses")
+
+        return key, embedding
+
+    def get_memory(self, key):
+        now = time.time()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+
+                self._remove(key)
+
+        return None
+
+    def get_disk(self, key):
+        now = time.time()
+
+        embedding = self._disk_get(key, now)
+
+        if embedding is not None:
+            self._count("disk_hits")
+            self._put_memory(key, embedding, now)
+            return embedding
+
+        self._count("misses")
+
+        return None
+
+    # the counters are updated from the event loop and from the storage threads
+    def _count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def put_memory(self, key, embedding):
+        self._put_memory(key, embedding, time.time())
+
+    def put_disk(self, key, embedding):
+        self._disk_put(key, embedding)
+
+    def _put_memory(self, key, embedding, now):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (now + self.ttl, embedding)
+            self.size += embedding.nbytes
+
+            # evict the least recently used
+            while self.size > self.max_bytes and len(self.entries) > 0:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, embedding = self.entries.pop(key)
+        self.size -= embedding.nbytes
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + ".npy")
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None
+
+        path = self._disk_path(key)
+
+        try:
+            if os.path.getmtime(path) + self.ttl <= now:
+                os.remove(path)
+                return None
+
+            return np.load(path)
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key, embedding):
+        if not self.disk_dir:
+            return
+
+        try:
+            # write and rename, a reader never sees a partial file
+            # the dir is shared by the workers: a temp file per writer
+            tmp_path = self._disk_path(key) + "." + str(os.getpid()) + "-" + uuid.uuid4().hex[:8] + ".tmp.npy"
+            np.save(tmp_path, embedding)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError as e:
+            log.error("Writing embedding to disk cache failed: " + str(e))
+
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "size_bytes": self.size,
+            }
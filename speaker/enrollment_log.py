@@ -0,0 +1,215 @@
+#
+# Append-only log of the changes to the centroids DB (add and delete of speakers)
+# a change costs an O(1) append instead of a rewrite of the whole DB.
+# The DB is: last snapshot (the centroids file) + the changes in the log.
+# Every ENROLLMENT_LOG_COMPACT_EVERY changes the log is compacted in a new snapshot.
+#
+# One json record per line, written through the store of the DB (append, list, remove):
+# local: the file ENROLLMENT_LOG_FILE_NAME (in BASE_DIR)
+# cloud: Object Storage has no append, one small object per group of records
+#        under BUCKET_PREFIX + ENROLLMENT_LOG_FILE_NAME + "/"
+#
+# Every record has an id: the compaction removes only the records in the snapshot (read or appended
+# by this process, with NUM_WORKERS > 1 by any worker: see set_known), the records appended meanwhile
+# by other nodes are kept.
+# updated:  18/10/2026
+#
+import json
+import uuid
+import logging
+import threading
+
+import numpy as np
+
+# global configs
+import config
+
+from centroid_store import create_store
+
+log = logging.getLogger("server")
+
+OP_ADD = "add"
+OP_DELETE = "delete"
+
+
+class EnrollmentLog:
+    def __init__(self, store=None):
+        self.store = store if store is not None else create_store()
+        self.log_name = config.global_settings['ENROLLMENT_LOG_FILE_NAME']
+
+        # number of records in the log
+        self.count = 0
+
+        # the ids of the records in the DB in use: read or appended by this process (or the workers)
+        self.known = set()
+
+        # part -> (version, records) of the last read: a part not changed is not read again
+        self.parts = {}
+
+        # held by the appends and, in the server, during the compaction
+        self.lock = threading.RLock()
+
+    #
+    # append one change, durable when the function returns
+    #
+    def append(self, op, name, centroid=None):
+        return self.append_many([(op, name, centroid)])
+
+    #
+    # append many changes (op, name, centroid) with a single write (one fsync, one object)
+    # returns the ids of the records, in the order of the changes
+    #
+    def append_many(self, changes):
+        lines = []
+        ids = []
+
+        for op, name, centroid in changes:
+            record = {"id": uuid.uuid4().hex, "op": op, "name": name}
+            ids.append(record["id"])
+
+            if centroid is not None:
+                # same structure of the centroids json file: [[512 floats]]
+                record["centroid"] = np.asarray(centroid, dtype=np.float64).reshape(1, -1).tolist()
+
+            lines.append(json.dumps(record) + "\n")
+
+        with self.lock:
+            self.store.append(self.log_name, "".join(lines).encode('utf-8'))
+
+            self.known.update(ids)
+            self.count += len(changes)
+
+        return ids
+
+    #
+    # all the records, in order
+    #
+    def read(self):
+        records = self._read_log()
+
+        with self.lock:
+            self.known = set(record_key(record) for record in records)
+            self.count = len(records)
+
+        return records
+
+    #
+    # after an append: the records not in applied (the ids in the DB before it), in order,
+    # with the ones appended meanwhile by other nodes. Then all the log is in the DB:
+    # count is the number of records in the log, the same for every node that has read it
+    #
+    def read_new(self, applied):
+        return [record for record in self.read() if record_key(record) not in applied]
+
+    def _read_log(self):
+        records = []
+        parts = {}
+
+        for part, version in self.store.list(self.log_name):
+            cached = self.parts.get(part)
+
+            if cached is not None and cached[0] == version:
+                part_records = cached[1]
+            else:
+                part_records = self._read_part(part)
+
+            parts[part] = (version, part_records)
+            records.extend(part_records)
+
+        self.parts = parts
+
+        return records
+
+    def _read_part(self, part):
+        records = []
+
+        try:
+            with self.store.open_read(part) as fp:
+                content = fp.read().decode('utf-8')
+        except FileNotFoundError:
+            # removed by a compaction after the list
+            return records
+
+        for line in content.splitlines():
+            line = line.strip()
+
+            # a partial last line (crash during append) is ignored
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                if line:
+                    log.error("Skipping invalid record in enrollment log")
+
+        return records
+
+    #
+    # after the compaction: removes the records read or appended by this process (now in the snapshot)
+    # all_records: removes also the records of the other processes (restore)
+    #
+    def truncate(self, all_records=False):
+        with self.lock:
+            # no append to the part while it is rewritten
+            with self.store.lock(self.log_name):
+                for part, _ in self.store.list(self.log_name):
+                    self._truncate_part(part, all_records)
+
+            self.known = set()
+            self.count = 0
+
+    def _truncate_part(self, part, all_records):
+        records = [] if all_records else self._read_part(part)
+
+        kept = [record for record in records if record_key(record) not in self.known]
+
+        if len(kept) == 0:
+            self.store.remove(part)
+            return
+
+        if len(kept) == len(records):
+            return
+
+        log.info("Keeping " + str(len(kept)) + " records appended by other processes in the enrollment log")
+
+        # open_write replaces the part when closed, a reader never sees a partial log
+        with self.store.open_write(part) as fp:
+            fp.write("".join(json.dumps(record) + "\n" for record in kept).encode('utf-8'))
+
+    #
+    # changes at every append and truncate, also by another process (for the refresh of the DB)
+    #
+    def version(self):
+        return tuple(self.store.list(self.log_name))
+
+    #
+    # the records in the DB published by another worker (NUM_WORKERS > 1):
+    # its appends are removed by the compaction of this worker too
+    #
+    def set_known(self, ids):
+        with self.lock:
+            self.known = set(ids)
+            self.count = len(self.known)
+
+    def needs_compaction(self):
+        return self.count >= config.global_settings['ENROLLMENT_LOG_COMPACT_EVERY']
+
+#
+# the id of a record, the records written before the ids by their content
+#
+def record_key(record):
+    if "id" in record:
+        return record["id"]
+
+    return json.dumps(record, sort_keys=True)
+
+#
+# apply the changes in records to the centroids dict (in place)
+# applying twice the same records gives the same result
+#
+def replay(centroids, records):
+    for record in records:
+        if record["op"] == OP_ADD:
+            centroids[record["name"]] = record["centroid"]
+        elif record["op"] == OP_DELETE:
+            centroids.pop(record["name"], None)
+
+    return centroids
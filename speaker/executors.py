@@ -0,0 +1,120 @@
+#
+# Executors of the stages of a request, used by the async handlers in server.py
+# features: pool of processes (decode, VAD, filter banks are CPU bound)
+# model: threads for the inference (with the BatchingEngine they share forward passes)
+# storage: threads for the I/O on the centroids DB (local or Object Storage)
+# cache: threads for the disk tier of the embedding cache (not queued behind a reload of the DB)
+#
+# every stage has a max number of jobs in flight (queued + running): when it is full
+# the request is rejected (Overloaded, 429 from the server) instead of waiting in an unbounded queue
+# updated:  18/10/2026
+#
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# global configs
+import config
+
+from metrics import collect_call, observe_all, QUEUE_DEPTH
+
+log = logging.getLogger("server")
+
+
+class Overloaded(Exception):
+    def __init__(self, stage):
+        super().__init__("Too many requests in stage " + stage)
+        self.stage = stage
+
+
+class BoundedExecutor:
+    def __init__(self, name, executor, max_pending, collect_stages=False):
+        self.name = name
+        self.executor = executor
+        self.max_pending = max_pending
+
+        # in processes: the timings of the stages come back with the result
+        self.collect_stages = collect_stages
+
+        # jobs in flight, changed only in the event loop (no lock)
+        self.pending = 0
+
+        QUEUE_DEPTH.labels(name).set_function(lambda: self.pending)
+
+    #
+    # run fn(*args) in the executor, raises Overloaded if the stage is full
+    #
+    async def run(self, fn, *args):
+        self._admit()
+
+        try:
+            return await self._submit(asyncio.get_running_loop(), fn, *args)
+        finally:
+            self.pending -= 1
+
+    #
+    # fn on every item (a tuple of args), in chunks: one job for the admission
+    # (a batch doesn't fill the queue), the chunks run in parallel
+    #
+    async def map(self, fn, items, num_chunks):
+        self._admit()
+
+        try:
+            size = max(1, -(-len(items) // num_chunks))
+            chunks = [items[i:i + size] for i in range(0, len(items), size)]
+
+            loop = asyncio.get_running_loop()
+            results = await asyncio.gather(*[self._submit(loop, run_chunk, fn, chunk) for chunk in chunks])
+
+            return [r for chunk in results for r in chunk]
+        finally:
+            self.pending -= 1
+
+    async def _submit(self, loop, fn, *args):
+        if not self.collect_stages:
+            return await loop.run_in_executor(self.executor, fn, *args)
+
+        result, timings = await loop.run_in_executor(self.executor, collect_call, fn, *args)
+        observe_all(timings)
+
+        return result
+
+    def _admit(self):
+        if self.pending >= self.max_pending:
+            log.warning("Stage " + self.name + " is full, request rejected")
+            raise Overloaded(self.name)
+
+        self.pending += 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+# top level, to be pickled to the processes
+def run_chunk(fn, items):
+    return [fn(*args) for args in items]
+
+#
+# the executors, as set in config
+#
+def create_feature_executor():
+    # spawn: the processes don't inherit the model (TensorFlow is not fork safe)
+    pool = ProcessPoolExecutor(max_workers=config.global_settings['FEATURE_WORKERS'],
+                               mp_context=multiprocessing.get_context("spawn"))
+
+    return BoundedExecutor("features", pool, config.global_settings['FEATURE_MAX_PENDING'], collect_stages=True)
+
+def create_model_executor():
+    pool = ThreadPoolExecutor(max_workers=config.global_settings['MODEL_WORKERS'], thread_name_prefix="model")
+
+    return BoundedExecutor("model", pool, config.global_settings['MODEL_MAX_PENDING'])
+
+def create_storage_executor():
+    pool = ThreadPoolExecutor(max_workers=config.global_settings['STORAGE_WORKERS'], thread_name_prefix="storage")
+
+    return BoundedExecutor("storage", pool, config.global_settings['STORAGE_MAX_PENDING'])
+
+def create_cache_executor():
+    pool = ThreadPoolExecutor(max_workers=config.global_settings['CACHE_WORKERS'], thread_name_prefix="cache")
+
+    return BoundedExecutor("cache", pool, config.global_settings['CACHE_MAX_PENDING'])
@@ -0,0 +1,116 @@
+#
+# Metrics of the service, in Prometheus format (endpoint /metrics)
+# histograms of the latency of every stage (decode, vad, fbank, embed, score) and of the requests,
+# counters (requests, errors, cache hits, ...) and gauges (speakers, queue depth)
+#
+# the stages run also in the features processes: there the timings (and the counts, e.g. the decode path)
+# are collected and returned with the result, then observed here (collect_call, observe_all)
+# updated:  18/10/2026
+#
+import time
+import threading
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily
+
+# buckets in seconds, from 0.5 ms (a stage on a short clip) to 10 s (a batch)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+
+STAGE_SECONDS = Histogram("speaker_stage_seconds", "Latency of the stages of a request", ["stage"],
+                          buckets=LATENCY_BUCKETS)
+
+REQUEST_SECONDS = Histogram("speaker_request_seconds", "Latency of the requests", ["endpoint"],
+                            buckets=LATENCY_BUCKETS)
+REQUESTS = Counter("speaker_requests_total", "Requests received", ["endpoint"])
+ERRORS = Counter("speaker_errors_total", "Requests failed (status >= 400)", ["endpoint", "status"])
+
+DECODE_PATHS = Counter("speaker_decode_path_total", "Audio decoded, by path (fast, resample, librosa)", ["path"])
+
+BATCH_SIZE = Histogram("speaker_batch_size", "Items in a forward pass of the model",
+                       buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+# gauges: the value is read when /metrics is scraped (set_function), no cost on the hot path
+SPEAKERS = Gauge("speaker_enrolled_speakers", "Speakers in the centroids DB")
+QUEUE_DEPTH = Gauge("speaker_queue_depth", "Jobs in flight in a stage (queued + running)", ["stage"])
+
+# the counters that can be incremented in the features processes (see count)
+COLLECTED_COUNTERS = {"decode_path": DECODE_PATHS}
+
+# the timings and counts collected in this thread (in a features process), None: observed directly
+_local = threading.local()
+
+#
+# time a stage: with stage("fbank"): ...
+#
+@contextmanager
+def stage(name):
+    tStart = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - tStart)
+
+def observe(name, seconds):
+    _record("stage", name, seconds)
+
+#
+# increment a counter of COLLECTED_COUNTERS: count("decode_path", "fast")
+#
+def count(counter, label, amount=1):
+    _record(counter, label, amount)
+
+def _record(metric, label, value):
+    collected = getattr(_local, "collected", None)
+
+    if collected is not None:
+        collected.append((metric, label, value))
+    else:
+        _apply(metric, label, value)
+
+def _apply(metric, label, value):
+    if metric == "stage":
+        STAGE_SECONDS.labels(label).observe(value)
+    else:
+        COLLECTED_COUNTERS[metric].labels(label).inc(value)
+
+#
+# in the features processes: returns (fn(*args), timings of the stages and counts)
+#
+def collect_call(fn, *args):
+    _local.collected = []
+
+    try:
+        return fn(*args), _local.collected
+    finally:
+        _local.collected = None
+
+# in the server: the timings and counts returned by collect_call
+def observe_all(timings):
+    for metric, label, value in timings:
+        _apply(metric, label, value)
+
+#
+# counters kept elsewhere (e.g. the embedding cache): fn returns a dict label value -> count
+# read when /metrics is scraped
+#
+class CallbackCounter:
+    def __init__(self, name, description, label, fn):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.fn = fn
+
+        REGISTRY.register(self)
+
+    def collect(self):
+        family = CounterMetricFamily(self.name, self.description, labels=[self.label])
+
+        for value, count in self.fn().items():
+            family.add_metric([value], count)
+
+        yield family
+
+def latest():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -6,35 +6,73 @@
 # updated:  18/10/2021
 # based on some code from https://github.com/philipperemy/deep-speaker
 #
-import io
 import time
+
+# for the report of the startup stages
+tBoot = time.perf_counter()
+
+import asyncio
+import threading
+from typing import Optional, List
+from functools import lru_cache
 import os
 import logging
 import json
 import uvicorn
 import numpy as np
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect, Request
+from starlette.websockets import WebSocketState
+from contextlib import contextmanager, nullcontext
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 
-# needed for the cloud, access to Object Storage
-import oci
-import ocifs
+tWeb = time.perf_counter()
 
 # global configurations in config.py
 import config
 
-# the DL model
-from conv_models import DeepSpeakerModel
+# micro-batching of the inference requests
+from batching import BatchingEngine
+
+# streaming identification
+from streaming import StreamingEmbedder
+
+# window selection for the embedding
+from audio_utils_new import CROP_POLICIES, read_mfcc_io, try_read_mfcc_io, read_archive, ArchiveTooLarge
+
+# executors of the stages of a request (features, model, storage)
+from executors import create_feature_executor, create_model_executor, create_storage_executor, create_cache_executor
+from executors import Overloaded
+
+# metrics (/metrics)
+from metrics import stage, latest, CallbackCounter, REQUESTS, ERRORS, REQUEST_SECONDS, SPEAKERS
+
+# cache of the embeddings
+from embedding_cache import EmbeddingCache
+
+# the in-memory index used for scoring
+from centroid_index import create_index, create_index_from_dict, centroids_from_matrix
+
+# the centroids DB shared between the workers
+from shared_centroids import SharedCentroids
 
 # code for adding new speakers to DB
-from speaker_management import add_speaker
+from speaker_management import speaker_windows_from_file, centroid_from_windows
+
+# log of the changes to the DB
+from enrollment_log import EnrollmentLog, replay, record_key, OP_ADD, OP_DELETE
+
+# the DB in memory: immutable snapshots, changes through the mutation queue
+from centroids_db import Snapshot, MutationQueue, format_version, next_version
+
+# reload in background of the DB changed by other nodes
+from centroid_refresher import CentroidRefresher
+
+# storage of the centroids DB (local, Object Storage)
+from centroid_store import create_store, NEW
 
 # utilities functions
-from utilities import compute_embeddings, distance_cosine_similarity, print_dict
-from utilities import load_centroids_newfile, save_wav, swap_centroids_files_local, swap_centroids_files_oss
-from utilities import NumpyArrayEncoder, load_centroids_from_oss, load_centroids_from_local
-from utilities import create_path, write_new_centroids_to_oss, write_new_centroids_to_local
-from utilities import restore_centroids_from_bck_local, restore_centroids_from_bck_oss, get_list_speakers_names
+from utilities import embed_mfcc, embed_clips, print_dict
+from utilities import create_path, get_list_speakers_names
 
 #
 # constants for audio processing
@@ -50,6 +88,28 @@ logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
 
 log.info("Starting the server...")
 
+#
+# startup stages and their duration (sec.), reported in the log and by /readyz
+# TensorFlow, the model and the centroids DB are loaded in background (start_service):
+# the HTTP server answers at once (/healthz), /readyz is OK when all is loaded
+#
+startup_stages = {}
+startup_error = None
+service_ready = threading.Event()
+
+def report_stage(name, seconds):
+    startup_stages[name] = round(seconds, 3)
+    log.info("Startup stage " + name + ": " + str(round(seconds, 3)) + " sec.")
+
+@contextmanager
+def startup_stage(name):
+    tStart = time.perf_counter()
+    yield
+    report_stage(name, time.perf_counter() - tStart)
+
+report_stage("import web framework", tWeb - tBoot)
+report_stage("import service modules", time.perf_counter() - tWeb)
+
 #
 # Functions
 #
@@ -58,143 +118,547 @@ log.info("Starting the server...")
 # load the pre-trained DL model
 #
 def load_model():
+    # the DL model
+    # imported here (TensorFlow takes seconds to import): in background at startup,
+    # and the features processes, that import this module, don't need it
+    with startup_stage("import tensorflow"):
+        from conv_models import DeepSpeakerModel
+
     log.info("Loading the DL model...")
 
     CONFIG_TYPE = config.global_settings['CONFIG_TYPE']
     MODEL_FILE = config.global_settings['MODEL_FILE']
 
-    vmodel = DeepSpeakerModel()
+    with startup_stage("build model"):
+        vmodel = DeepSpeakerModel()
 
     # renamed model file to model.h5 (was: ResCNN_triplet_training_checkpoint_265.h5)
     
     # continue to load local file
     # but the model is not changing.. do we need a special location?
     # we can continue to ship with the code !
-    vmodel.m.load_weights(create_path(MODEL_FILE), by_name=True)
+    with startup_stage("load weights"):
+        vmodel.m.load_weights(create_path(MODEL_FILE), by_name=True)
+
+    log.info("Warming up the DL model...")
+    with startup_stage("warm up model"):
+        vmodel.warm_up()
 
     return vmodel
 #
-# This loads the centroids file DB and handle the two cases: local, cloud CONFIG
+# This loads the centroids file DB, from the store for CONFIG_TYPE
+# returns the centroids and the version of the DB (snapshot and changes of the log)
 #
 def load_centroids():
     log.info("Loading the centroids DB...")
 
-    CONFIG_TYPE = config.global_settings['CONFIG_TYPE']
+    # read before the file: if it is replaced meanwhile, the next refresh loads it again
+    snapshot_version = centroid_store.db_version()
 
-    # with CONFIG_TYPE we manage the different storage in Cloud (Object storage)
-    # and locally (on fs)
-    if CONFIG_TYPE == "local":
-        new_centroids = load_centroids_from_local()
-    else:
-        if CONFIG_TYPE == "cloud":
-            new_centroids = load_centroids_from_oss()        
+    new_centroids = centroid_store.load()
+
+    # apply the changes logged after the last snapshot
+    records = enrollment_log.read()
+
+    if len(records) > 0:
+        log.info("Applying " + str(len(records)) + " changes from the enrollment log")
+        new_centroids = replay(dict(new_centroids), records)
 
     log.info("Number of distinct speakers: " + str(len(new_centroids)))
 
-    return new_centroids 
+    return new_centroids, format_version(snapshot_version, len(records))
 
 #
-# swap centroid files
+# restore and reload, the changes after the last snapshot are discarded too
 #
-def swap_centroids_files():
-    log.info("Swapping the centroids DB...")
+def restore_and_reload():
+    with db_lock, shared_db_lock():
+        log.info("Restoring the centroids DB...")
+        centroid_store.restore()
 
-    CONFIG_TYPE = config.global_settings['CONFIG_TYPE']
+        enrollment_log.truncate(all_records=True)
 
-    if CONFIG_TYPE == "local":
-        swap_centroids_files_local()
-    else:
-        if CONFIG_TYPE == "cloud":
-            swap_centroids_files_oss()
+        update_centroids(*load_centroids(), locked=True)
+        mark_db_current()
+
+        return db.version
 
 #
-# This handle the centroids file restore and handle the two cases: local, cloud CONFIG
+# force the reload of the DB (/reload)
 #
-def restore_centroids_from_bck():
-    log.info("Restoring the centroids DB...")
+def reload_centroids():
+    with db_lock:
+        reload_from_storage()
+        mark_db_current()
 
-    CONFIG_TYPE = config.global_settings['CONFIG_TYPE']
+        return db.version
 
-    # with CONFIG_TYPE we manage the different storage in Cloud (Object storage)
-    # and locally (on fs)
-    if CONFIG_TYPE == "local":
-        restore_centroids_from_bck_local()
-    else:
-        if CONFIG_TYPE == "cloud":
-            restore_centroids_from_bck_oss()        
-
-    return 
+#
+# the DB in storage becomes the one in use (by all the workers), the caller holds db_lock
+# with NUM_WORKERS > 1 load and publish under the lock of the shared DB: a change of another worker
+# can't be published in between (it would be replaced by the older DB loaded here)
+#
+def reload_from_storage():
+    with shared_db_lock():
+        update_centroids(*load_centroids(), locked=True)
+
+# the version of the DB in storage: snapshot and enrollment log
+def db_storage_version():
+    return (centroid_store.current_version(), enrollment_log.version())
+
+# after a change done by this process: the refresher has not to reload it
+def mark_db_current():
+    if refresher is not None:
+        try:
+            refresher.mark_current()
+        except Exception as e:
+            # the change is done: at worst the refresher reloads the DB
+            log.error("Reading the version of the centroids DB failed: " + str(e))
 
 # return the dictionary with all scores
 # score is the distance between the current sound vector and the centroid
 # current sound vector is in embedding
 # list is limited to MAX_RESULTS
-def compare_other_centroids(embedding, centroids):
-    tmp_dict = {}
-        
-    for key in centroids.keys():
-        dist = round(distance_cosine_similarity(embedding, centroids[key])[0], 3)
-        tmp_dict[key] = dist
-        
-    # sort
-    tmp_list = sorted(tmp_dict.items(), key=lambda x:x[1])
-    # in tmp_list I have tuples like ('Lorenzo_DeMarchis', 0.278)
-
-    # here I limit to MAX_RESULTS
-    new_tmp_list = []
-
-    for i, el in enumerate(tmp_list):
-        if i < config.global_settings['MAX_RESULTS']:
-            new_dict = {}
-            # unpack the tuple
-            new_dict['name'] = el[0]
-            new_dict['result'] = el[1]
-            new_tmp_list.append(new_dict)
+# scoring is done on the centroids index (exact or approximate, see SEARCH_BACKEND)
+def compare_other_centroids(embedding, index):
+    with stage("score"):
+        tmp_list = index.search(embedding, config.global_settings['MAX_RESULTS'])
 
     out_dict = {} 
-    out_dict["result"] = new_tmp_list
+    out_dict["result"] = format_results(tmp_list)
     
     return out_dict
 
-def compute_distances(embedding, centroids):
-    dict_dist = {}
-    
-    for key in centroids.keys():
-        dist = round(distance_cosine_similarity(embedding, centroids[key])[0], 3)
+# in tmp_list I have tuples like ('Lorenzo_DeMarchis', 0.278)
+def format_results(tmp_list):
+    new_tmp_list = []
 
-        dict_dist[key] = dist
+    for el in tmp_list:
+        new_dict = {}
+        # unpack the tuple
+        new_dict['name'] = el[0]
+        new_dict['result'] = el[1]
+        new_tmp_list.append(new_dict)
 
-    # sort
-    tmp_list = sorted(dict_dist.items(), key=lambda x:x[1])
-    
-    # here I limit to MAX_RESULTS
-    new_tmp_list = []
+    return new_tmp_list
+
+# all the embeddings (B, EMBEDDING_DIMS) in one product
+def search_batch(embeddings, index, k):
+    with stage("score"):
+        return index.search_batch(embeddings, k)
 
-    for i, el in enumerate(tmp_list):
-        if i < config.global_settings['MAX_RESULTS']:
-            new_tmp_list.append(el)
+def compute_distances(embedding, index):
+    # already sorted and limited to MAX_RESULTS
+    tmp_list = index.search(embedding, config.global_settings['MAX_RESULTS'])
 
-    out_dict = dict(new_tmp_list)
+    out_dict = dict(tmp_list)
     
     return out_dict
 
+#
+# set the centroids DB in memory and (re)build the index used for scoring
+# the index is built by the caller (storage thread, refresher), not in the requests:
+# then the new snapshot is swapped in with a single assignment.
+# A request reads db once and uses that snapshot until it ends
+#
+def set_centroids(new_centroids, version, new_index=None):
+    if new_index is None:
+        new_index = create_index_from_dict(new_centroids)
+
+    set_snapshot(Snapshot(version, new_centroids, new_index))
+
+def set_snapshot(snapshot):
+    global db
+
+    db = snapshot
+
+#
+# to be used after a change of the DB (add, delete, reload, restore)
+# with NUM_WORKERS > 1 the change is published to all the workers
+# locked: the caller holds the lock of the shared DB (see shared_db_lock)
+#
+def update_centroids(new_centroids, version, locked=False):
+    if shared_db is not None:
+        shared_db.publish(new_centroids, version, enrollment_log.known, locked)
+        refresh_centroids()
+
+        # already in use here, the poller has not to swap it again
+        if shared_poller is not None:
+            shared_poller.mark_current()
+    else:
+        set_centroids(new_centroids, version)
+
+#
+# with NUM_WORKERS > 1, pick up the changes published by the other workers
+# in background (shared_poller), never in the requests: the index is built in that thread
+# it is only a read of the shared version counter if nothing has changed
+#
+def refresh_centroids():
+    global centroids_version
+
+    if shared_db is None or shared_db.current_version() == centroids_version:
+        return
+
+    version, names, matrix, db_version, log_ids = shared_db.read()
+
+    log.info("Using centroids DB version " + db_version)
+
+    # the changes appended by the other workers are in the DB: compacted here too
+    enrollment_log.set_known(log_ids)
+
+    # no copy: index and dict are views on the shared matrix
+    set_centroids(centroids_from_matrix(names, matrix), db_version, create_index(names, matrix))
+    centroids_version = version
+
+#
+# with NUM_WORKERS > 1 the changes of the workers are serialized between processes
+#
+def shared_db_lock():
+    if shared_db is None:
+        return nullcontext()
+
+    return shared_db.lock()
+
+#
+# add (or replace) and delete speakers, in the writer thread of the mutation queue
+# changes is the list of (op, name, centroid) collected: one append to the enrollment log,
+# then one new snapshot (no rewrite and reload). Returns the version of the DB with the changes
+# with NUM_WORKERS > 1 the changes are applied on the last DB published by any worker
+#
+# a failure of the append is raised (the changes are not done), after it the changes are durable:
+# the failures are logged and recovered, not returned to the callers
+#
+def apply_changes(changes):
+    with db_lock, shared_db_lock():
+        # the changes of the other workers, not yet swapped in by the poller
+        refresh_centroids()
+
+        applied = set(enrollment_log.known)
+
+        ids = enrollment_log.append_many(changes)
+
+        # the last change of a name wins
+        updates = {}
+        for op, name, centroid in read_new_changes(applied, ids, changes):
+            updates[name] = centroid if op == OP_ADD else None
+
+        # the number of records in the persisted log, not of the changes seen by this process
+        version = next_version(db.version, enrollment_log.count - len(applied))
+
+        if shared_db is not None:
+            new_centroids = dict(db.centroids)
+            for name, centroid in updates.items():
+                if centroid is None:
+                    new_centroids.pop(name, None)
+                else:
+                    new_centroids[name] = centroid
+
+            version = try_compaction(new_centroids, version)
+
+            try:
+                # published to all the workers
+                update_centroids(new_centroids, version, locked=True)
+            except Exception as e:
+                log.error("Publishing the changes to the workers failed, used only here: " + str(e))
+                set_centroids(new_centroids, version)
+        else:
+            snapshot = db.updated(updates, version)
+
+            # not yet visible to the requests: the version can still change
+            snapshot.version = try_compaction(snapshot.centroids, version)
+
+            set_snapshot(snapshot)
 
+        mark_db_current()
 
-# load the DL model
-model = load_model()
+        return db.version
 
-# load the centroids file
-# file must be modified every time a new speaker is added
 #
-centroids = load_centroids()
+# after the append of changes (with ids): the changes of the log not in applied, in the order of the log,
+# the ones appended by other nodes too: the DB is the snapshot and all the log, as loaded by a restart
+# if the log can't be read only these changes are applied (the others at the next refresh)
+#
+def read_new_changes(applied, ids, changes):
+    try:
+        records = enrollment_log.read_new(applied)
+    except Exception as e:
+        log.error("Reading the enrollment log failed, applying only the new changes: " + str(e))
+        return changes
+
+    own = dict(zip(ids, changes))
+
+    new_changes = []
+    for record in records:
+        if record_key(record) in own:
+            new_changes.append(own[record_key(record)])
+        else:
+            new_changes.append((record["op"], record["name"], record.get("centroid")))
+
+    if len(new_changes) > len(changes):
+        log.info("Applying " + str(len(new_changes) - len(changes)) + " changes appended by other nodes")
+
+    return new_changes
+
+#
+# compaction, if the log is long enough: returns the version of the DB after it
+# if it fails the log is kept, retried at the next change
+#
+def try_compaction(centroids, version):
+    if not enrollment_log.needs_compaction():
+        return version
+
+    try:
+        return compact_centroids(centroids)
+    except Exception as e:
+        log.error("Compaction of the enrollment log failed, retried at the next change: " + str(e))
+
+        return version
+
+#
+# write the DB in memory as the new snapshot (centroids file)
+# then the changes in the log are no more needed: only the ones in the snapshot are removed
+# no append of this process between the snapshot and the truncate
+# returns the version of the DB: the new snapshot, no changes in the log
+#
+def compact_centroids(centroids):
+    log.info("Compacting the enrollment log")
+
+    with enrollment_log.lock:
+        snapshot_version = centroid_store.write_new(dict(centroids))
+
+        # swap the files
+        log.info("Swap centroids files")
+        centroid_store.publish()
+
+        enrollment_log.truncate()
+
+    return format_version(snapshot_version, 0)
+
+#
+# load the DL model and the centroids DB
+#
+def init_service():
+    global model, shared_db, shared_poller, refresher, mutations
+
+    # load the DL model
+    model = load_model()
+
+    # concurrent requests share a batched forward pass
+    if config.global_settings['BATCHING_ENABLED']:
+        log.info("Starting the batching engine...")
+        model = BatchingEngine(model)
+
+    # load the centroids file
+    # file must be modified every time a new speaker is added
+    #
+    with startup_stage("load centroids DB"):
+        if config.global_settings['NUM_WORKERS'] > 1:
+            shared_db = SharedCentroids()
+            shared_db.open(lambda: load_centroids() + (enrollment_log.known,))
+            refresh_centroids()
+        else:
+            set_centroids(*load_centroids())
+
+    # the changes published by the other workers are swapped in by a background thread
+    if shared_db is not None:
+        shared_poller = CentroidRefresher(shared_db.current_version, refresh_centroids, db_lock,
+                                          config.global_settings['SHARED_DB_POLL_INTERVAL'], "shared-db-poller")
+        shared_poller.start()
+
+    # all the changes to the DB go through the mutation queue
+    mutations = MutationQueue(apply_changes)
+
+    # check for the changes done by other nodes
+    # with NUM_WORKERS > 1 only in one worker: it publishes the new DB, the others swap it in (shared_poller)
+    if config.global_settings['DB_REFRESH_INTERVAL'] > 0:
+        refresher = CentroidRefresher(db_storage_version, reload_from_storage, db_lock,
+                                      active_fn=shared_db.try_lead if shared_db is not None else None)
+        refresher.start()
+
+#
+# in background, at the startup of the HTTP server
+#
+def start_service():
+    global startup_error
+
+    try:
+        init_service()
+    except Exception as e:
+        startup_error = str(e)
+        log.error("Startup failed: " + startup_error)
+        return
+
+    report_stage("total", time.perf_counter() - tBoot)
+
+    service_ready.set()
+
+
+model = None
+centroid_store = create_store()
+enrollment_log = EnrollmentLog(centroid_store)
+embedding_cache = EmbeddingCache() if config.global_settings['EMBEDDING_CACHE_ENABLED'] else None
+feature_executor = create_feature_executor()
+model_executor = create_model_executor()
+storage_executor = create_storage_executor()
+cache_executor = create_cache_executor()
+
+SPEAKERS.set_function(lambda: len(db.index) if db.index is not None else 0)
+
+if embedding_cache is not None:
+    CallbackCounter("speaker_embedding_cache", "Lookups in the embedding cache", "result",
+        lambda: {r: embedding_cache.stats()[r] for r in ("hits", "disk_hits", "misses", "bypassed")})
+
+# the DB in memory (snapshot): dict name -> centroid, index used for scoring, version
+db = Snapshot(format_version(0, 0), {}, None)
+centroids_version = -1
+
+# serializes the changes of the DB (mutation queue, reload, restore, refresher)
+db_lock = threading.Lock()
+mutations = None
+refresher = None
+shared_db = None
+shared_poller = None
 
 # create the app
 app = FastAPI(title=config.global_settings['TITLE'], version=config.global_settings['VERSION'], 
         description=config.global_settings['DESCRIPTION'])
 
+#
+# model and DB are loaded only in the processes serving the app:
+# with NUM_WORKERS > 1 not in the supervisor, never in the features processes
+#
+@app.on_event("startup")
+def startup():
+    threading.Thread(target=start_service, name="startup", daemon=True).start()
+
 #
 # functions handling HTTP requests
+# the handlers are async: the work is done in the executors of the stages, the event loop stays free
+#
+
+#
+# until model and DB are loaded only the probes (and the docs) are available
+# (registered before request_metrics, that wraps it: the 503 are counted)
+#
+NOT_READY_PATHS = ("/healthz", "/readyz", "/metrics", "/", "/docs", "/openapi.json")
+
+@app.middleware("http")
+async def check_ready(request: Request, call_next):
+    if not service_ready.is_set() and request.url.path not in NOT_READY_PATHS:
+        return JSONResponse(status_code=503, content={"detail": "Service is starting."}, headers={"Retry-After": "5"})
+
+    return await call_next(request)
+
+#
+# count and time every request (by endpoint)
+#
+@app.middleware("http")
+async def request_metrics(request: Request, call_next):
+    tStart = time.perf_counter()
+
+    # only the paths of the API as labels (not any path requested)
+    endpoint = request.url.path
+    if endpoint not in api_paths():
+        endpoint = "other"
+
+    REQUESTS.labels(endpoint).inc()
+
+    try:
+        response = await call_next(request)
+    except Exception:
+        ERRORS.labels(endpoint, "500").inc()
+        raise
+
+    if response.status_code >= 400:
+        ERRORS.labels(endpoint, str(response.status_code)).inc()
+
+    REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - tStart)
+
+    return response
+
+# computed once, at the first request (all the routes are registered)
+@lru_cache(maxsize=1)
+def api_paths():
+    return frozenset(route.path for route in app.routes)
+
+#
+# liveness: the process is up
+#
+@app.get("/healthz", tags=["Operation"])
+def healthz():
+    out_dict = {}
+    out_dict['status'] = "ok"
+
+    return out_dict
+
 #
+# readiness: model and centroids DB are loaded (503 until then)
+#
+@app.get("/readyz", tags=["Operation"])
+def readyz():
+    out_dict = {}
+    out_dict['ready'] = service_ready.is_set()
+    out_dict['stages'] = startup_stages
+
+    if startup_error is not None:
+        out_dict['error'] = startup_error
+
+    if not service_ready.is_set():
+        return JSONResponse(status_code=503, content=out_dict)
+
+    return out_dict
+
+#
+# a stage is full: the client should retry later
+#
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+#
+# the embedding of the clip, from the cache if the same clip has already been seen
+# features in the processes, model in the model threads
+#
+async def get_embeddings(file, crop=None):
+    key = None
+
+    if embedding_cache is not None:
+        key, embedding = embedding_cache.lookup(file, None, crop)
+
+        # the disk tier in the cache threads
+        if embedding is None and key is not None and embedding_cache.disk_dir:
+            embedding = await run_cache_io(embedding_cache.get_disk, key)
+
+        if embedding is not None:
+            return embedding
+
+    mfcc = await feature_executor.run(read_mfcc_io, file, SAMPLE_RATE)
+
+    embedding = await model_executor.run(embed_mfcc, mfcc, model, None, crop)
+
+    if key is not None:
+        embedding_cache.put_memory(key, embedding)
+
+        if embedding_cache.disk_dir:
+            await run_cache_io(embedding_cache.put_disk, key, embedding)
+
+    return embedding
+
+#
+# I/O on the disk tier of the cache: with the cache stage full the tier is skipped, not the request
+#
+async def run_cache_io(fn, *args):
+    try:
+        return await cache_executor.run(fn, *args)
+    except Overloaded:
+        return None
+
+#
+# crop (optional in identify and verify) overrides CROP_POLICY for the request
+#
+def check_crop_policy(crop):
+    if crop is not None and crop not in CROP_POLICIES:
+        raise HTTPException(status_code=422, detail="crop must be one of: " + ", ".join(CROP_POLICIES))
 
 #
 # This is the function that handles the POST request for identification
@@ -203,18 +667,24 @@ app = FastAPI(title=config.global_settings['TITLE'], version=config.global_setti
 # where distance is the distance from the given input and the centroid for name
 #
 @app.post("/identify", tags=["Identification"]) 
-def identify(file: bytes = File(...)):
+async def identify(file: bytes = File(...), crop: Optional[str] = None):
     
     # for timing the request
     tStart = time.time()
     
     log.info('Identify: Received a request')
 
+    # the DB used for this request, whatever changes meanwhile
+    snapshot = db
+
+    check_crop_policy(crop)
+
     try:
-        embedding = compute_embeddings(file, model)
+        embedding = await get_embeddings(file, crop)
         
         # compare with all centroids
-        out_dict = compare_other_centroids(embedding, centroids)
+        out_dict = await model_executor.run(compare_other_centroids, embedding, snapshot.index)
+        out_dict['db_version'] = snapshot.version
         
         print_dict(out_dict)
         
@@ -222,6 +692,8 @@ def identify(file: bytes = File(...)):
         print()
         print('Elapsed time (sec.)', round(tEla, 3))
         
+    except Overloaded:
+        raise
     except Exception as e:
         print('The exception is:', e)
         print("Input is not a valid audio file!")
@@ -234,25 +706,31 @@ def identify(file: bytes = File(...)):
 # if names is in first NUM_CANDIDATES return OK
 #
 @app.post("/verify", tags=["Identification"]) 
-def verify(name: str, file: bytes = File(...)):
+async def verify(name: str, file: bytes = File(...), crop: Optional[str] = None):
 
     # for timing the request
     tStart = time.time()
     
     log.info('Verify: Received a request')
 
+    # the DB used for this request, whatever changes meanwhile
+    snapshot = db
+
+    check_crop_policy(crop)
+
     final_dict_out = {}
 
     try:
-        embedding = compute_embeddings(file, model)
+        embedding = await get_embeddings(file, crop)
         
         # compare with all centroids
         # out dict is already in iorder of increasing distance
-        out_dict = compare_other_centroids(embedding, centroids)
+        out_dict = await model_executor.run(compare_other_centroids, embedding, snapshot.index)
 
         # compute the summary result
         final_dict_out["summary"] = "false"
         final_dict_out['result'] = out_dict
+        final_dict_out['db_version'] = snapshot.version
 
         list_pair = out_dict["result"]
 
@@ -270,6 +748,8 @@ def verify(name: str, file: bytes = File(...)):
         print()
         print('Elapsed time (sec.)', round(tEla, 3))
         
+    except Overloaded:
+        raise
     except Exception as e:
         print('The exception is:', e)
         print("Input is not a valid audio file!")
@@ -277,6 +757,217 @@ def verify(name: str, file: bytes = File(...)):
     
     return final_dict_out
 
+#
+# Identification of many clips in one request
+# the clips are sent as a list of files (files) or as a zip/tar archive (archive)
+# decode and features run concurrently, the model on the windows of all the clips
+# together and the scoring is one (B, 512) x (512, N) product.
+# Returns the first k speakers (default MAX_RESULTS) for every clip, in the order received
+#
+@app.post("/identify_batch", tags=["Identification"])
+async def identify_batch(files: List[UploadFile] = File(None), archive: UploadFile = File(None),
+                   k: Optional[int] = None, crop: Optional[str] = None):
+
+    # for timing the request
+    tStart = time.time()
+
+    log.info('Identify batch: Received a request')
+
+    # the DB used for this request, whatever changes meanwhile
+    snapshot = db
+
+    check_crop_policy(crop)
+
+    if k is None:
+        k = config.global_settings['MAX_RESULTS']
+
+    max_clips = config.global_settings['IDENTIFY_BATCH_MAX_CLIPS']
+    max_clip_bytes = config.global_settings['IDENTIFY_BATCH_MAX_CLIP_BYTES']
+    max_bytes = config.global_settings['IDENTIFY_BATCH_MAX_BYTES']
+
+    clips = []
+    total_bytes = 0
+
+    # the same limits of the clips in an archive, in the same total
+    for f in (files or []):
+        # at most one byte over the limit is read
+        file = await f.read(max_clip_bytes + 1)
+
+        if len(file) > max_clip_bytes:
+            raise HTTPException(status_code=413, detail="Clip " + str(f.filename) + " too large, max is " +
+                str(max_clip_bytes) + " bytes.")
+
+        total_bytes += len(file)
+
+        if total_bytes > max_bytes:
+            raise HTTPException(status_code=413, detail="Clips too large, max is " + str(max_bytes) + " bytes in total.")
+
+        clips.append((f.filename, file))
+
+    if archive is not None:
+        content = await archive.read()
+
+        if len(content) > max_bytes - total_bytes:
+            raise HTTPException(status_code=413, detail="Clips too large, max is " + str(max_bytes) + " bytes in total.")
+
+        # decompression in the processes, as the decode of the clips
+        try:
+            clips.extend(await feature_executor.run(read_archive, content, max(0, max_clips - len(clips)),
+                                                    max_bytes - total_bytes))
+        except Overloaded:
+            raise
+        except ArchiveTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e) + ".")
+        except Exception as e:
+            print('The exception is:', e)
+            raise HTTPException(status_code=415, detail="Unsupported archive provided.")
+
+    if len(clips) == 0:
+        raise HTTPException(status_code=422, detail="No clips provided.")
+
+    if len(clips) > max_clips:
+        raise HTTPException(status_code=413, detail="Too many clips, max is " + str(max_clips))
+
+    # the clips in FEATURE_WORKERS chunks, in parallel
+    mfccs = await feature_executor.map(try_read_mfcc_io, [(file, SAMPLE_RATE) for _, file in clips],
+                                       config.global_settings['FEATURE_WORKERS'])
+
+    valid = [i for i, mfcc in enumerate(mfccs) if mfcc is not None]
+
+    results = [None] * len(clips)
+
+    if len(valid) > 0:
+        embeddings = await model_executor.run(embed_clips, [mfccs[i] for i in valid], model, None, crop)
+
+        search_results = await model_executor.run(search_batch, embeddings, snapshot.index, k)
+
+        for i, tmp_list in zip(valid, search_results):
+            results[i] = tmp_list
+
+    out_list = []
+
+    for (name, _), tmp_list in zip(clips, results):
+        clip_dict = {}
+        clip_dict['file'] = name
+
+        if tmp_list is None:
+            clip_dict['error'] = "Unsupported file provided."
+        else:
+            clip_dict['result'] = format_results(tmp_list)
+
+        out_list.append(clip_dict)
+
+    out_dict = {}
+    out_dict['results'] = out_list
+    out_dict['db_version'] = snapshot.version
+
+    tEla = time.time() - tStart
+    print()
+    print('Clips:', len(clips), 'Elapsed time (sec.)', round(tEla, 3))
+
+    return out_dict
+
+#
+# Streaming identification over websocket
+# the client sends binary messages with the audio (PCM 16 bit mono at SAMPLE_RATE)
+# as it is spoken, and a text message "end" at the end.
+# The server sends a provisional result every STREAM_EMIT_EVERY_FRAMES frames
+# ({"type": "partial", ...}) and the final one ({"type": "final", ...})
+#
+@app.websocket("/identify_stream")
+async def identify_stream(websocket: WebSocket):
+    await websocket.accept()
+
+    log.info('Identify stream: Received a request')
+
+    if not service_ready.is_set():
+        # 1013: try again later
+        await websocket.close(code=1013)
+        return
+
+    # the DB used for this request, whatever changes meanwhile
+    snapshot = db
+
+    session = StreamingEmbedder(model)
+
+    try:
+        while True:
+            message = await websocket.receive()
+
+            if message["type"] == "websocket.disconnect":
+                return
+
+            if message.get("bytes") is not None:
+                # feature extraction and model out of the event loop
+                embedding = await model_executor.run(session.push, message["bytes"])
+
+                if embedding is not None:
+                    out_dict = await model_executor.run(compare_other_centroids, embedding, snapshot.index)
+                    out_dict["type"] = "partial"
+                    out_dict["db_version"] = snapshot.version
+
+                    await websocket.send_json(out_dict)
+
+            elif message.get("text") == "end":
+                break
+
+        embedding = await model_executor.run(session.finish)
+
+        out_dict = await model_executor.run(compare_other_centroids, embedding, snapshot.index)
+        out_dict["type"] = "final"
+        out_dict["db_version"] = snapshot.version
+
+        print_dict(out_dict)
+
+        await websocket.send_json(out_dict)
+        await websocket.close()
+
+    except WebSocketDisconnect:
+        # the client has gone, nothing to close
+        log.info('Identify stream: client disconnected')
+    except Overloaded as e:
+        print('The exception is:', e)
+        # 1013: try again later
+        await close_websocket(websocket, 1013)
+    except Exception as e:
+        print('The exception is:', e)
+        print("Input is not a valid audio stream!")
+        # 1003: unsupported data
+        await close_websocket(websocket, 1003)
+
+# close only if still open (the client may have disconnected meanwhile)
+async def close_websocket(websocket, code):
+    if websocket.client_state != WebSocketState.CONNECTED or websocket.application_state != WebSocketState.CONNECTED:
+        return
+
+    try:
+        await websocket.close(code=code)
+    except RuntimeError as e:
+        log.info("Websocket already closed: " + str(e))
+
+#
+# hits/misses of the embeddings cache
+#
+@app.get("/cache_stats", tags=["Operation"])
+def cache_stats():
+    out_dict = {}
+    out_dict['enabled'] = embedding_cache is not None
+
+    if embedding_cache is not None:
+        out_dict.update(embedding_cache.stats())
+
+    return out_dict
+
+#
+# metrics in Prometheus format
+# with NUM_WORKERS > 1 every worker has its own (the one answering the scrape)
+#
+@app.get("/metrics", tags=["Operation"])
+def get_metrics():
+    content, content_type = latest()
+
+    return Response(content=content, media_type=content_type)
+
 # By using @app.get("/") you are allowing the GET method to work for the / endpoint.
 @app.get("/", tags=["Operation"])
 def home():
@@ -288,14 +979,16 @@ def home():
 #
 @app.get("/list_speakers", tags=["Operation"])
 def list_speakers(ordered: str = "false"):
-    global centroids
-
     log.info('List speakers: Received a request')
+
+    # the DB used for this request, whatever changes meanwhile
+    snapshot = db
     
-    list_speakers = get_list_speakers_names(centroids, ordered)
+    list_speakers = get_list_speakers_names(snapshot.centroids, ordered)
 
     out_dict = {}
     out_dict['speakers'] = list_speakers
+    out_dict['db_version'] = snapshot.version
 
     print_dict(out_dict)
 
@@ -304,123 +997,97 @@ def list_speakers(ordered: str = "false"):
 # This function handles the request for adding a new speaker to the DB
 #
 @app.post("/add_speaker", tags=["Operation"]) 
-def add_new_speaker(name: str, file: bytes = File(...)):
-    global centroids
-
+async def add_new_speaker(name: str, file: bytes = File(...)):
     log.info("Adding speaker: "  + name)
-    
+
     # for timing the request
     tStart = time.time()
 
     try:
-        # save in a wav file in the local dir
-        save_wav(name, file)
-
-        filename = create_path(name + ".wav")
+        # compute the centroid for the new speaker
+        # the audio is processed in memory, no wav files are written
+        windows = await feature_executor.run(speaker_windows_from_file, file)
 
-        # create the new_centroids structure
-        new_centroids = add_speaker(name, filename, centroids, model)
+        centroid = await model_executor.run(centroid_from_windows, windows, model)
 
-        # if CONFIG = cloud must copy new centroids to OSS
-        if config.global_settings['CONFIG_TYPE'] == "cloud":
-            log.info("Writing new centroid to oss")
-            write_new_centroids_to_oss(new_centroids)
-        else:
-            # local
-            log.info("Writing new centroid to local")
-            write_new_centroids_to_local(new_centroids)
+    except Overloaded:
+        raise
+    except Exception as e:
+        print('The exception is:', e)
+        print("Input is not a valid!")
+        raise HTTPException(status_code=415, detail="Unsupported request.")
 
-        # swap the files (handles the double config cloud or local)
-        log.info("Swap centroids files")
-        swap_centroids_files()
+    # log the change and update the DB in memory (with other changes received meanwhile)
+    log.info("Adding new centroid")
+    version = await submit_change(OP_ADD, name, centroid)
 
-        # reload
-        log.info("Reload centroids")
-        centroids = load_centroids()
+    out_dict = {}
+    out_dict['result'] = "true"
+    out_dict['db_version'] = version
 
-        out_dict = {}
-        out_dict['result'] = "true"
+    tEla = time.time() - tStart
+    print()
+    print('Elapsed time (sec.)', round(tEla, 3))
 
-        tEla = time.time() - tStart
-        print()
-        print('Elapsed time (sec.)', round(tEla, 3))
+    return out_dict
 
+#
+# the change through the mutation queue, returns the version of the DB with it
+# a failure of the writer (the change is not done) is a server error, not a bad request
+#
+async def submit_change(op, name, centroid=None):
+    try:
+        return await asyncio.wrap_future(mutations.submit(op, name, centroid))
+    except Overloaded:
+        raise
     except Exception as e:
         print('The exception is:', e)
-        print("Input is not a valid!")
-        raise HTTPException(status_code=415, detail="Unsupported request.")
-
-    return out_dict
+        raise HTTPException(status_code=500, detail="Change of the centroids DB failed.")
 #
 # delete speaker
 #
 @app.post("/delete_speaker", tags=["Operation"])
-def delete_speaker(name: str):
-    global centroids
-
+async def delete_speaker(name: str):
     log.info("Delete a speaker from DB")
 
-    # create the new_centroids without speaker = name
-    # check if name is in speakers list
-    list_speakers = get_list_speakers_names(centroids, ordered=False)
-
-    if name in list_speakers:
-        # Cancel, operate on a copy
-        new_centroids = centroids.copy()
- 
-        # Remove the speaker from the data structure
-        del new_centroids[name]
-
-        # now save
-        if config.global_settings['CONFIG_TYPE'] == "cloud":
-            log.info("Writing new centroid to oss")
-            write_new_centroids_to_oss(new_centroids)
-        else:
-            # local
-            log.info("Writing new centroid to local")
-            write_new_centroids_to_local(new_centroids)
+    version = db.version
 
-        # swap
-        log.info("Swap centroids files")
-        swap_centroids_files()
-
-        # after creating the new centroids file, reload it
-        centroids = load_centroids()
+    # check if name is in speakers list
+    if name in db.centroids:
+        # log the change and update the DB in memory
+        version = await submit_change(OP_DELETE, name)
     else:
         # do nothing
         log.info(name + " not in list speakers")
 
     dict_out = {}
     dict_out["result"] = "true"
+    dict_out["db_version"] = version
 
     return dict_out
 #
 # force the reload of the centroids file
 #
 @app.get("/reload", tags=["Operation"])
-def reload():
-    global centroids
-
-    centroids = load_centroids()
+async def reload():
+    version = await storage_executor.run(reload_centroids)
 
     out_dict = {}
     out_dict['result'] = "true"
+    out_dict['db_version'] = version
 
     return out_dict
 #
 # restore of the centroids file
 #
 @app.get("/restore_centroids", tags=["Operation"])
-def restore_centroids():
-    global centroids
-
+async def restore_centroids():
     print("Restore centroids")
-    restore_centroids_from_bck()
-
-    centroids = load_centroids()
+    version = await storage_executor.run(restore_and_reload)
 
     out_dict = {}
     out_dict['result'] = "true"
+    out_dict['db_version'] = version
 
     return out_dict
 
@@ -429,9 +1096,9 @@ def restore_centroids():
 # the list can be sorted
 #
 @app.get("/list_speakers_from_newfile", tags=["Operation"])
-def list_speakers_from_newfile(ordered: str = "false"):
+async def list_speakers_from_newfile(ordered: str = "false"):
     
-    new_centroids = load_centroids_newfile()
+    new_centroids = await storage_executor.run(centroid_store.load, NEW)
 
     list_speakers = []
 
@@ -454,5 +1121,12 @@ def list_speakers_from_newfile(ordered: str = "false"):
 if __name__ == '__main__':
     # set IP on which is listening, port
     # listen on all IP
-    uvicorn.run(app, host=config.global_settings['IP'], port=config.global_settings['PORT'])
+    NUM_WORKERS = config.global_settings['NUM_WORKERS']
+
+    if NUM_WORKERS > 1:
+        # every worker is a process with its own model, the centroids DB is shared
+        uvicorn.run("server:app", host=config.global_settings['IP'], port=config.global_settings['PORT'],
+            workers=NUM_WORKERS)
+    else:
+        uvicorn.run(app, host=config.global_settings['IP'], port=config.global_settings['PORT'])
 
@@ -0,0 +1,180 @@
+#
+# Centroids DB shared between the worker processes (NUM_WORKERS > 1)
+# the centroids matrix sits in files in SHARED_DB_DIR (on Linux /dev/shm is in memory)
+# that every worker maps read-only (np.load with mmap_mode), so there is a single copy.
+# A version counter (also mapped) is bumped at every change (add, delete, reload, restore):
+# workers compare it with the version they have and re-map the DB, no restart needed.
+# updated:  18/10/2026
+#
+import os
+import json
+import fcntl
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+
+# global configs
+import config
+
+from centroid_index import centroids_to_matrix
+
+log = logging.getLogger("server")
+
+# ctl[0] is the version of the DB, ctl[1] the pid of the supervisor that owns it
+CTL_FILE_NAME = "ctl"
+LOCK_FILE_NAME = "lock"
+# held by the worker that refreshes the DB from storage for all the workers of the host
+LEADER_FILE_NAME = "leader"
+
+
+class SharedCentroids:
+    def __init__(self, shared_dir=None):
+        self.shared_dir = shared_dir if shared_dir is not None else config.global_settings['SHARED_DB_DIR']
+
+        os.makedirs(self.shared_dir, exist_ok=True)
+
+        self.ctl = None
+
+        # open (and locked) only in the leader
+        self.leader_file = None
+
+    def _path(self, fname):
+        return os.path.join(self.shared_dir, fname)
+
+    def _matrix_path(self, version):
+        return self._path("db_%d.npy" % version)
+
+    def _names_path(self, version):
+        return self._path("db_%d.json" % version)
+
+    #
+    # serialize the writers (and the first initialization) between processes
+    #
+    @contextmanager
+    def _lock(self):
+        with open(self._path(LOCK_FILE_NAME), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    #
+    # to be called once in every worker. The first worker (of this supervisor)
+    # publishes the DB loaded with load_fn (centroids, version, log_ids), the others find it already there.
+    # A DB left in SHARED_DB_DIR by a previous run (other supervisor) is replaced
+    #
+    def open(self, load_fn):
+        owner = os.getppid()
+
+        with self._lock():
+            ctl_path = self._path(CTL_FILE_NAME)
+
+            if not os.path.exists(ctl_path):
+                np.zeros(2, dtype=np.int64).tofile(ctl_path)
+
+            self.ctl = np.memmap(ctl_path, dtype=np.int64, mode="r+", shape=(2,))
+
+            if self.ctl[1] != owner:
+                log.info("Publishing the centroids DB in shared memory")
+                self._publish(*load_fn())
+                self.ctl[1] = owner
+                self.ctl.flush()
+
+    def current_version(self):
+        return int(self.ctl[0])
+
+    #
+    # a change based on the current DB (read, change, publish) by one worker at a time:
+    #   with shared_db.lock(): read, change, publish(centroids, locked=True)
+    #
+    def lock(self):
+        return self._lock()
+
+    #
+    # write a new version of the DB and make it visible to all the workers
+    # db_version: the version of the DB (from the persisted state), returned by read
+    # log_ids: the ids of the records of the enrollment log in the DB, removed by the compaction
+    # whatever worker appended them
+    # locked: the caller holds lock() (flock is per open file: taking it again would block)
+    #
+    def publish(self, centroids, db_version, log_ids=(), locked=False):
+        if locked:
+            return self._publish(centroids, db_version, log_ids)
+
+        with self._lock():
+            return self._publish(centroids, db_version, log_ids)
+
+    def _publish(self, centroids, db_version, log_ids=()):
+        old_version = self.current_version()
+        version = old_version + 1
+
+        names = list(centroids.keys())
+        matrix = centroids_to_matrix(centroids)
+
+        # write to tmp files and rename, readers never see a partial file
+        tmp_path = self._path("tmp.npy")
+        np.save(tmp_path, matrix)
+        os.replace(tmp_path, self._matrix_path(version))
+
+        tmp_path = self._path("tmp.json")
+        with open(tmp_path, "w") as fp:
+            json.dump({"version": db_version, "names": names, "log_ids": sorted(log_ids)}, fp)
+        os.replace(tmp_path, self._names_path(version))
+
+        # now the workers can pick it up
+        self.ctl[0] = version
+        self.ctl.flush()
+
+        # workers still using the old version keep their mapping (unlink removes only the name)
+        for path in (self._matrix_path(old_version), self._names_path(old_version)):
+            if os.path.exists(path):
+                os.remove(path)
+
+        log.info("Published centroids DB version " + str(db_version) + " (" + str(version) + ")")
+
+        return version
+
+    #
+    # True if this worker is the leader: the first that takes the lock keeps it until it exits
+    # (the lock is released by the OS), then another worker takes over at its next try
+    #
+    def try_lead(self):
+        if self.leader_file is not None:
+            return True
+
+        leader_file = open(self._path(LEADER_FILE_NAME), "w")
+
+        try:
+            fcntl.flock(leader_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            leader_file.close()
+            return False
+
+        log.info("This worker refreshes the centroids DB for all the workers")
+        self.leader_file = leader_file
+
+        return True
+
+    #
+    # map the current version of the DB
+    # returns version (of the shared copy), names, the (N, EMBEDDING_DIMS) read-only matrix,
+    # the version of the DB and the ids of the records of the enrollment log in it
+    #
+    def read(self):
+        while True:
+            version = self.current_version()
+
+            try:
+                with open(self._names_path(version), "r") as fp:
+                    content = json.load(fp)
+
+                matrix = np.load(self._matrix_path(version), mmap_mode="r")
+            except FileNotFoundError:
+                # a new version has been published in the meantime, retry
+                if version == self.current_version():
+                    raise
+                continue
+
+            return version, content["names"], matrix, content["version"], content.get("log_ids", [])
@@ -0,0 +1,262 @@
+#
+# Streaming identification (websocket /identify_stream)
+# the audio arrives in chunks while it is spoken: filter banks are computed incrementally,
+# every window of NUM_FRAMES frames (every STREAM_WINDOW_STRIDE frames) is embedded and
+# the running average of the embeddings gives a provisional result
+# every STREAM_EMIT_EVERY_FRAMES frames, and the final one when the stream is closed.
+#
+# the client sends binary messages with PCM 16 bit little endian mono at SAMPLE_RATE
+# (the first message can start with the header of a wav file, it is skipped)
+#
+# silence is removed before the filter banks as in identify (VAD_MODE), block by block (StreamingVad)
+# updated:  18/10/2026
+#
+from collections import deque
+
+import numpy as np
+
+# global configs
+import config
+
+from constants import SAMPLE_RATE, NUM_FBANKS, NUM_FRAMES
+from audio_utils_new import preemphasis, frame_params, frame_signal, frames_fbank, normalize_frames, pad_mfcc
+from wav_decoder import parse_wav_header, WAVE_FORMAT_PCM
+from utilities import embed_mfcc_batch
+
+#
+# filter banks computed incrementally
+# same frames (and values) as mfcc_fbank on the whole signal
+#
+class StreamingFbank:
+    def __init__(self, sample_rate=SAMPLE_RATE, nfilt=NUM_FBANKS):
+        self.sample_rate = sample_rate
+        self.nfilt = nfilt
+        self.frame_len, self.frame_step = frame_params(sample_rate)
+
+        # preemphasized samples not yet consumed by a frame (float64 as in fbank)
+        self.buf = np.zeros(0)
+        self.prev = None
+
+        self.num_samples = 0
+        self.num_frames = 0
+
+    def _features(self, frames):
+        feat, _ = frames_fbank(frames, self.sample_rate, self.nfilt)
+        return normalize_frames(feat).astype(np.float32)
+
+    #
+    # returns the features (n, nfilt) of the frames completed with these samples
+    #
+    def push(self, samples):
+        if len(samples) == 0:
+            return np.zeros((0, self.nfilt), dtype=np.float32)
+
+        emph = preemphasis(samples, self.prev)
+        self.prev = samples[-1]
+
+        self.buf = np.concatenate((self.buf, emph))
+        self.num_samples += len(samples)
+
+        if len(self.buf) < self.frame_len:
+            return np.zeros((0, self.nfilt), dtype=np.float32)
+
+        n = 1 + (len(self.buf) - self.frame_len) // self.frame_step
+
+        feats = self._features(frame_signal(self.buf, n, self.frame_len, self.frame_step))
+
+        self.buf = self.buf[n * self.frame_step:]
+        self.num_frames += n
+
+        return feats
+
+    #
+    # at the end of the stream: the last frame, zero padded (as fbank does)
+    #
+    def flush(self):
+        if self.num_samples <= self.frame_len:
+            total = 1
+        else:
+            total = 1 + int(np.ceil((self.num_samples - self.frame_len) / self.frame_step))
+
+        if self.num_samples == 0 or total <= self.num_frames:
+            return np.zeros((0, self.nfilt), dtype=np.float32)
+
+        padded = np.zeros(self.frame_len)
+        padded[:len(self.buf)] = self.buf
+
+        self.num_frames = total
+
+        return self._features(padded.reshape(1, -1))
+
+#
+# silence removal on the stream, in blocks of one frame step (10 ms) as vad_energy
+# a block is speech if its energy (dB) is within VAD_DYNAMIC_RANGE_DB of the loudest block
+# received so far and above VAD_FLOOR_DB (the whole signal is not known: the loudest one until now)
+# energy: only the speech blocks, with VAD_HANGOVER_FRAMES blocks around them
+# percentile: the silence before the first and after the last speech block is removed
+#            (as the trim of identify, the pauses in the middle are kept)
+# none: all the audio
+#
+class StreamingVad:
+    def __init__(self, sample_rate=SAMPLE_RATE, mode=None):
+        self.mode = mode if mode is not None else config.global_settings['VAD_MODE']
+        _, self.step = frame_params(sample_rate)
+
+        self.range_db = config.global_settings['VAD_DYNAMIC_RANGE_DB']
+        self.floor_db = config.global_settings['VAD_FLOOR_DB']
+        self.hangover = config.global_settings['VAD_HANGOVER_FRAMES']
+
+        # samples not yet a complete block
+        self.buf = np.zeros(0, dtype=np.float32)
+        self.max_db = -np.inf
+
+        # silent blocks held back: given out only if speech follows
+        self.held = deque(maxlen=self.hangover if self.mode == "energy" else None)
+
+        # blocks since the last speech block, None before the first one
+        self.since_speech = None
+
+    #
+    # returns the samples to be processed (the silence removed)
+    # the silence held back at the end of the stream is never returned
+    #
+    def push(self, samples):
+        if self.mode not in ("energy", "percentile"):
+            return samples
+
+        self.buf = np.concatenate((self.buf, samples))
+
+        num_blocks = len(self.buf) // self.step
+
+        if num_blocks == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        blocks = self.buf[:num_blocks * self.step].reshape(num_blocks, self.step)
+        self.buf = self.buf[num_blocks * self.step:]
+
+        # mean power of the blocks, in dB (full scale = 0 dB)
+        power = np.einsum('ij,ij->i', blocks, blocks, dtype=np.float64) / self.step
+        db = 10. * np.log10(power + 1e-12)
+
+        out = []
+
+        for block, block_db in zip(blocks, db):
+            self.max_db = max(self.max_db, block_db)
+
+            if block_db > max(self.max_db - self.range_db, self.floor_db):
+                out.extend(self.held)
+                out.append(block)
+
+                self.held.clear()
+                self.since_speech = 0
+            elif self.mode == "energy" and self.since_speech is not None and self.since_speech < self.hangover:
+                out.append(block)
+                self.since_speech += 1
+            elif self.mode == "energy" or self.since_speech is not None:
+                # energy: the last blocks before speech, percentile: a pause (kept if speech follows)
+                self.held.append(block)
+
+        if len(out) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        return np.concatenate(out)
+
+#
+# one streaming session: bytes in, running average of the window embeddings out
+#
+class StreamingEmbedder:
+    def __init__(self, model):
+        self.model = model
+        self.vad = StreamingVad()
+        self.fbank = StreamingFbank()
+
+        self.stride = config.global_settings['STREAM_WINDOW_STRIDE']
+        self.emit_every = config.global_settings['STREAM_EMIT_EVERY_FRAMES']
+
+        # features of the frames not yet covered by a window
+        self.features = np.zeros((0, NUM_FBANKS), dtype=np.float32)
+
+        self.sum = np.zeros(config.global_settings['EMBEDDING_DIMS'], dtype=np.float64)
+        self.count = 0
+
+        self.frames_since_emit = 0
+        self.header_checked = False
+        self.pending_byte = b''
+
+    #
+    # samples from a message: PCM 16 bit, a byte can be split between two messages
+    #
+    def _samples(self, data):
+        if not self.header_checked:
+            self.header_checked = True
+
+            header = parse_wav_header(data)
+
+            if header is not None:
+                format_tag, channels, rate, bits, offset, _ = header
+
+                if format_tag != WAVE_FORMAT_PCM or bits != 16 or channels != 1 or rate != SAMPLE_RATE:
+                    raise ValueError("Stream must be PCM 16 bit mono at " + str(SAMPLE_RATE) + " Hz")
+
+                data = data[offset:]
+
+        data = self.pending_byte + data
+
+        self.pending_byte = data[len(data) - len(data) % 2:]
+        data = data[:len(data) - len(data) % 2]
+
+        return np.frombuffer(data, dtype='<i2').astype(np.float32) * np.float32(1. / 32768.)
+
+    #
+    # embed all the complete windows, keep the frames needed for the next ones
+    #
+    def _add_features(self, feats):
+        self.features = np.concatenate((self.features, feats))
+
+        starts = list(range(0, len(self.features) - NUM_FRAMES + 1, self.stride))
+
+        if len(starts) > 0:
+            windows = [np.expand_dims(self.features[s:s + NUM_FRAMES], axis=-1) for s in starts]
+
+            self.sum += np.sum(embed_mfcc_batch(windows, self.model), axis=0)
+            self.count += len(windows)
+
+            self.features = self.features[starts[-1] + self.stride:]
+
+        self.frames_since_emit += len(feats)
+
+    #
+    # process a chunk of audio
+    # returns the provisional embedding every STREAM_EMIT_EVERY_FRAMES frames, else None
+    #
+    def push(self, data):
+        self._add_features(self.fbank.push(self.vad.push(self._samples(data))))
+
+        if self.frames_since_emit >= self.emit_every and self.count > 0:
+            self.frames_since_emit = 0
+            return self.embedding()
+
+        return None
+
+    #
+    # end of the stream: the final embedding
+    #
+    def finish(self):
+        self._add_features(self.fbank.flush())
+
+        if self.count == 0:
+            # less than NUM_FRAMES in total: one padded window (as sample_from_mfcc)
+            if len(self.features) == 0:
+                raise ValueError("No audio received")
+
+            window = np.expand_dims(pad_mfcc(self.features, NUM_FRAMES), axis=-1)
+            self.sum += embed_mfcc_batch([window], self.model)[0]
+            self.count = 1
+
+        return self.embedding()
+
+    # average of the windows embeddings, norm one, shape (1, EMBEDDING_DIMS)
+    def embedding(self):
+        mean = self.sum / self.count
+
+        return (mean / np.linalg.norm(mean)).reshape(1, -1).astype(np.float32)
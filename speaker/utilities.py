@@ -4,23 +4,23 @@
 # based on some code from https://github.com/philipperemy/deep-speaker
 #
 import numpy as np
-import json
 from json import JSONEncoder
 import os
 import logging
-import shutil
-import ocifs
+import threading
 
 # global configs
 import config
 
 # our new utilities
-from audio_utils_new import sample_from_mfcc, read_mfcc_io
+from audio_utils_new import sample_from_mfcc, read_mfcc_io, tile_mfcc
 
 from constants import SAMPLE_RATE, NUM_FRAMES
 
-# the DL model
-from conv_models import DeepSpeakerModel
+from centroid_index import centroids_to_matrix
+
+# timers of the stages
+from metrics import stage
 
 # encoder used for saving the dictionary in a json format
 class NumpyArrayEncoder(JSONEncoder): 
@@ -36,133 +36,90 @@ log = logging.getLogger("server")
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', 
     level=os.environ.get("LOGLEVEL", "INFO"), datefmt='%Y-%m-%d %H:%M:%S')
 
-# add the BASE_DIR (taken from config) to fname
-def create_path(fname):
-    BASE_DIR = config.global_settings['BASE_DIR']
-    path = BASE_DIR + "/" + fname
-
-    return path
-
 #
-# distance defined on cosine similarity: return dist = (1 - cos_simil)
+# the filesystem for Object Storage (CONFIG_TYPE = cloud)
+# one long-lived instance: its client keeps the connections open between the calls
+# ocifs (and the oci SDK) are slow to import: imported only when used
+# set_oss_filesystem replaces it with any fsspec filesystem (e.g. "memory", for tests)
 #
-def distance_cosine_similarity(x1, x2):
-    # if similar speaker return a number close to 0
-    s = np.sum(np.multiply(x1, x2), axis=1)
+_oss_fs = None
+_oss_fs_lock = threading.Lock()
 
-    # as vectors have length 1, we don't need to divide by norm (as it is 1)
-    return abs(1. - s)
+def oss_filesystem():
+    global _oss_fs
 
-#
-# get list of speakers name as list
-#
-def get_list_speakers_names(centroids, ordered):
-    list_speakers = []
+    with _oss_fs_lock:
+        if _oss_fs is None:
+            import ocifs
 
-    for key in centroids.keys():
-        list_speakers.append(key)
-    
-    if ordered:
-        list_speakers = sorted(list_speakers)
-    
-    return list_speakers
-#
-# loads the centroids file from local fs
-# this function is used if CONFIG = local
-#
-def load_centroids_from_local():
-    CENTROIDS_FILE_NAME = config.global_settings['CENTROIDS_FILE_NAME']
+            _oss_fs = ocifs.OCIFileSystem(config="~/.oci/config")
 
-    log.info("Loading centroids file from local")
+    return _oss_fs
 
-    with open(create_path(CENTROIDS_FILE_NAME), 'r') as fp:
-        new_centroids = json.load(fp)
-    
-    log.info("Checking centroids file")
-    check_centroids_file(new_centroids)
+def set_oss_filesystem(fs):
+    global _oss_fs
+
+    with _oss_fs_lock:
+        _oss_fs = fs
 
-    return new_centroids
 #
-# loads the centroids file from Object Storage
-# this function is used if CONFIG = cloud
+# the version of an object: the ETag (changes at every write of the object)
+# for filesystems without ETag, a token from the info of the file
 #
-def load_centroids_from_oss():
-    BUCKET_PREFIX = config.global_settings['BUCKET_PREFIX']
-    CENTROIDS_FILE_NAME = config.global_settings['CENTROIDS_FILE_NAME']
-    F_NAME = BUCKET_PREFIX + CENTROIDS_FILE_NAME
-
-    log.info("Loading centroids file from Object Storage")
+def object_version(fs, path):
+    etag = fs.info(path).get("etag")
 
-    fs = ocifs.OCIFileSystem(config="~/.oci/config")
-                   
-    with fs.open(F_NAME) as fp:
-        new_centroids = json.load(fp)
+    return etag if etag is not None else fs.ukey(path)
 
-    log.info("Checking centroids file")
-    check_centroids_file(new_centroids)
+# add the BASE_DIR (taken from config) to fname
+def create_path(fname):
+    BASE_DIR = config.global_settings['BASE_DIR']
+    path = BASE_DIR + "/" + fname
 
-    return new_centroids
+    return path
 
 #
-# writes the changed centroid file to Object Storage, using ocifs
-# 
+# the name of a centroids file (key is CENTROIDS_FILE_NAME, NEW_... or BCK_...)
+# for the format in use (CENTROIDS_FORMAT): json or bin
 #
-def write_new_centroids_to_oss(new_centroids: dict):
-    BUCKET_PREFIX = config.global_settings['BUCKET_PREFIX']
-    NEW_CENTROIDS_FILE_NAME = config.global_settings['NEW_CENTROIDS_FILE_NAME']
-
-    log.info("Writing new centroids to Object Storage")
+def centroids_file_name(key):
+    fname = config.global_settings[key]
 
-    check_centroids_file(new_centroids)
+    if config.global_settings['CENTROIDS_FORMAT'] == "bin":
+        fname = fname.replace(".json", ".bin")
 
-    fs = ocifs.OCIFileSystem(config="~/.oci/config")
+    return fname
 
-    with fs.open(BUCKET_PREFIX + NEW_CENTROIDS_FILE_NAME, mode="w") as fp:
-                json.dump(new_centroids, fp, cls=NumpyArrayEncoder)
+def is_bin_format():
+    return config.global_settings['CENTROIDS_FORMAT'] == "bin"
 
 #
-# writes the changed centroid file to local fs
-# 
+# distance defined on cosine similarity: return dist = (1 - cos_simil)
 #
-def write_new_centroids_to_local(new_centroids: dict):
-    NEW_CENTROIDS_FILE_NAME = config.global_settings['NEW_CENTROIDS_FILE_NAME']
-
-    log.info("Writing centroids to local")
+def distance_cosine_similarity(x1, x2):
+    # if similar speaker return a number close to 0
+    s = np.sum(np.multiply(x1, x2), axis=1)
 
-    check_centroids_file(new_centroids)
+    # as vectors have length 1, we don't need to divide by norm (as it is 1)
+    return abs(1. - s)
 
-    with open(create_path(NEW_CENTROIDS_FILE_NAME), 'w') as fp:
-                json.dump(new_centroids, fp, cls=NumpyArrayEncoder)
 #
-# loads the new_centroids file, to check it
+# get list of speakers name as list
 #
-def load_centroids_newfile():
-    # always from local fs
-    CENTROIDS_FILE_NAME = config.global_settings['NEW_CENTROIDS_FILE_NAME']
-
-    # with CONFIG_TYPE we manage the different storage in Cloud (Object storage)
-    # and locally (on fs)
+def get_list_speakers_names(centroids, ordered):
+    # a single copy of the keys (the dict can be changed by add/delete)
+    list_speakers = list(centroids.keys())
     
-    with open(create_path(CENTROIDS_FILE_NAME), 'r') as fp:
-        new_centroids = json.load(fp)         
-
-    log.info("Number of distinct speakers: " + str(len(new_centroids)))
-
-    # check the content
-    if check_centroids_file(new_centroids) == False:
-        log.error("Error: Anomaly in centroid file, one of the embedding vector has not the expected size!")
-    else:
-        log.info("Embedding vectors size OK!")
-
-    return new_centroids
-
+    if ordered:
+        list_speakers = sorted(list_speakers)
+    
+    return list_speakers
 #
 # do some checks on the content of the centroid file
 # to be called after load_centroids
 #
 def check_centroids_file(centroids):
     isOK = True
-    EPS = 0.0001
 
     log.info("Checking embeddings size and norm")
 
@@ -175,57 +132,67 @@ def check_centroids_file(centroids):
     if isOK:
         log.info("Embeddings size (512) OK")
 
-    # check that all vector have norm = 1
-    for key in centroids.keys():
-        vec = np.array(centroids[key][0])
-        norm = np.linalg.norm(vec)
-
-        if abs(norm - 1.0) > EPS:
-            log.error("Error: norm is not 1")
-            isOK = False
-
-    if isOK:
-        log.info("Embeddings vector norm OK")
+        # check that all vector have norm = 1
+        isOK = check_centroids_matrix(centroids_to_matrix(centroids))
 
     return isOK
 
 #
-# save new wav file
+# check the norm of all the centroids (rows of the matrix) in one pass
 #
-def save_wav(name, file: bytes):
-    print("saving file for:", name)
+def check_centroids_matrix(matrix):
+    EPS = 0.0001
 
-    FNAME = name + ".wav"
-    FPATH = create_path(FNAME)
+    norms = np.linalg.norm(matrix, axis=1)
 
-    f = open(FPATH, 'wb')
-    f.write(file)
-    f.close()
+    if np.any(np.abs(norms - 1.0) > EPS):
+        log.error("Error: norm is not 1")
+        return False
 
-    return
+    log.info("Embeddings vector norm OK")
 
-def read_wav(file_name):
-    FPATH = create_path(file_name)
-
-    with open(FPATH, "rb") as f:
-        # read the entire file, is small (1000 points)
-        bytes_read = f.read()
-    
-    return bytes_read
+    return True
 
 #
 # Compute the embeddings vector for the wav
 # as input bytes read from wav
+# model can be the DeepSpeakerModel or the BatchingEngine in front of it
 #
-def compute_embeddings(file: bytes, model):
+def compute_embeddings(file: bytes, model, mode=None, crop=None):
      # compute mel cepstral coeff (mfcc)
-    mfcc = sample_from_mfcc(read_mfcc_io(file, SAMPLE_RATE), NUM_FRAMES)
+    return embed_mfcc(read_mfcc_io(file, SAMPLE_RATE), model, mode, crop)
+
+#
+# mode (EMBEDDING_MODE) can be:
+# single: the embedding of one window of NUM_FRAMES frames
+# multi: the average (norm one) of the embeddings of overlapping windows covering all the mfcc
+# crop is the policy used to choose the window in single mode (CROP_POLICY)
+#
+def embed_mfcc(mfcc, model, mode=None, crop=None):
+    if mode is None:
+        mode = config.global_settings['EMBEDDING_MODE']
+
+    if mode == "multi":
+        windows = tile_mfcc(mfcc, NUM_FRAMES, config.global_settings['MULTI_WINDOW_STRIDE'],
+                            config.global_settings['MULTI_WINDOW_MAX'])
+
+        if config.global_settings['IS_DEBUG']:
+            print('MFCC windows shape is:', windows.shape)
+
+        # all the windows in one batch
+        embeddings = embed_mfcc_batch(windows, model)
+
+        centroid = np.mean(embeddings, axis=0, keepdims=True)
+        embedding = centroid / np.linalg.norm(centroid)
+    else:
+        mfcc = sample_from_mfcc(mfcc, NUM_FRAMES, crop)
         
-    if config.global_settings['IS_DEBUG']:
+        if config.global_settings['IS_DEBUG']:
             print('MFCC shape is:', mfcc.shape)
         
-    # compute the embedding vector
-    embedding = model.m.predict(np.expand_dims(mfcc, axis=0))
+        # compute the embedding vector
+        with stage("embed"):
+            embedding = model.embed(np.expand_dims(mfcc, axis=0))
         
     if config.global_settings['IS_DEBUG']:
         print('Embedding shape is:', embedding.shape)
@@ -239,87 +206,60 @@ def compute_embeddings(file: bytes, model):
     return embedding
 
 #
-# for print
+# the mfcc windows (W, NUM_FRAMES, NUM_FBANKS, 1) that give the embedding of a clip
+# in mode (EMBEDDING_MODE): one window for single, overlapping windows for multi
 #
-def print_dict(diz):
-    print()
-    print("Result is:")
-    print(diz)
-
-    return
-
-def swap_centroids_files_local():
-    # rename centroids file as centroids.bck
-    # rename new_centroids file as centroids
+def mfcc_windows(mfcc, mode=None, crop=None):
+    if mode is None:
+        mode = config.global_settings['EMBEDDING_MODE']
 
-    BCK_PATH = create_path(config.global_settings['BCK_CENTROIDS_FILE_NAME'])
-    NEW_PATH = create_path(config.global_settings['NEW_CENTROIDS_FILE_NAME'])
-    CUR_PATH = create_path(config.global_settings['CENTROIDS_FILE_NAME'])
+    if mode == "multi":
+        return tile_mfcc(mfcc, NUM_FRAMES, config.global_settings['MULTI_WINDOW_STRIDE'],
+                         config.global_settings['MULTI_WINDOW_MAX'])
 
-    # backup CUR as BCK
-    log.info("backup CUR as BCK")
-    shutil.copyfile(CUR_PATH, BCK_PATH)
+    return np.expand_dims(sample_from_mfcc(mfcc, NUM_FRAMES, crop), axis=0)
 
-    # copy NEW as CUR
-    log.info("copy NEW as CUR")
-    shutil.copyfile(NEW_PATH, CUR_PATH)
-
-def swap_centroids_files_oss():
-    BUCKET_PREFIX = config.global_settings['BUCKET_PREFIX']
-    BCK = config.global_settings['BCK_CENTROIDS_FILE_NAME']
-    CUR = config.global_settings['CENTROIDS_FILE_NAME']
-    NEW = config.global_settings['NEW_CENTROIDS_FILE_NAME']
-
-    fs = ocifs.OCIFileSystem(config="~/.oci/config")
+#
+# the embeddings (B, EMBEDDING_DIMS) of many clips (list of mfcc), as embed_mfcc
+# the windows of all the clips are embedded together, in large batches
+#
+def embed_clips(mfccs, model, mode=None, crop=None):
+    windows = [mfcc_windows(mfcc, mode, crop) for mfcc in mfccs]
+    counts = [len(w) for w in windows]
 
-    # backup CUR as OLD
-    log.info("backup CUR as BCK")
+    embeddings = embed_mfcc_batch(np.concatenate(windows, axis=0), model)
 
-    # read CUR
-    with fs.open(BUCKET_PREFIX + CUR, 'r') as fp:
-        cur_centroids = json.load(fp)
-    
-    # write on BCK
-    with fs.open(BUCKET_PREFIX + BCK, mode="w") as fp:
-        json.dump(cur_centroids, fp, cls=NumpyArrayEncoder)
+    # multi: average of the windows of every clip, norm one
+    if max(counts) > 1:
+        sums = np.add.reduceat(embeddings, np.cumsum([0] + counts[:-1]), axis=0)
+        embeddings = sums / np.linalg.norm(sums, axis=1, keepdims=True)
 
-    # copy NEW as CUR
-    log.info("copy NEW as CUR")
+    return embeddings
 
-    # read NEW
-    with fs.open(BUCKET_PREFIX + NEW, 'r') as fp:
-        new_centroids = json.load(fp)
-    
-    # write on CUR
-    with fs.open(BUCKET_PREFIX + CUR, mode="w") as fp:
-        json.dump(new_centroids, fp, cls=NumpyArrayEncoder)
 #
-# handle the restore in case CONFIG local
+# Compute the embeddings for many mfcc windows (NUM_FRAMES, NUM_FBANKS, 1) in one call
+# stacked in a (S, NUM_FRAMES, NUM_FBANKS, 1) batch, in chunks of EMBEDDING_BATCH_SIZE
+# returns (S, EMBEDDING_DIMS)
 #
-def restore_centroids_from_bck_local():
-    BCK_PATH = create_path(config.global_settings['BCK_CENTROIDS_FILE_NAME'])
-    CUR_PATH = create_path(config.global_settings['CENTROIDS_FILE_NAME'])
+def embed_mfcc_batch(windows, model):
+    BATCH_SIZE = config.global_settings['EMBEDDING_BATCH_SIZE']
 
-    log.info("restore BCK as CUR")
-    shutil.copyfile(BCK_PATH, CUR_PATH)
+    batch = np.stack(windows).astype(np.float32)
 
-#
-# handle the restore in case CONFIG cloud
-#
-def restore_centroids_from_bck_oss():
-    BUCKET_PREFIX = config.global_settings['BUCKET_PREFIX']
-    BCK = config.global_settings['BCK_CENTROIDS_FILE_NAME']
-    CUR = config.global_settings['CENTROIDS_FILE_NAME']
+    if config.global_settings['IS_DEBUG']:
+        print('Batch shape is:', batch.shape)
 
-    log.info("restore BCK as CUR")
+    with stage("embed"):
+        embeddings = [model.embed(batch[i:i + BATCH_SIZE]) for i in range(0, len(batch), BATCH_SIZE)]
 
-    fs = ocifs.OCIFileSystem(config="~/.oci/config")
+    return np.concatenate(embeddings, axis=0)
 
-    with fs.open(BUCKET_PREFIX + BCK, 'r') as fp:
-        new_centroids = json.load(fp)
-    
-    # write
-    with fs.open(BUCKET_PREFIX + CUR, mode="w") as fp:
-        json.dump(new_centroids, fp, cls=NumpyArrayEncoder)
+#
+# for print
+#
+def print_dict(diz):
+    print()
+    print("Result is:")
+    print(diz)
 
-    
\ No newline at end of file
+    return
@@ -0,0 +1,110 @@
+#
+# Fast decoding of the uploaded audio
+# most clients send wav PCM at SAMPLE_RATE: the RIFF header is parsed here and the samples
+# are taken with np.frombuffer (no copy until the conversion to float32).
+# librosa (slow to import, it pulls in numba) is used only when needed:
+# to resample (rate != SAMPLE_RATE) or for formats not handled here (e.g. mp3, 24 bit)
+# updated:  18/10/2026
+#
+import struct
+import io
+
+import numpy as np
+
+from metrics import count
+
+# decoding paths taken, for diagnostic (metric speaker_decode_path_total)
+PATH_FAST = "fast"
+PATH_RESAMPLE = "resample"
+PATH_LIBROSA = "librosa"
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+#
+# parse the RIFF header
+# returns (format tag, channels, sample rate, bits per sample, data offset, data size)
+# or None if it is not a wav file
+#
+def parse_wav_header(buf):
+    if len(buf) < 12 or buf[0:4] != b'RIFF' or buf[8:12] != b'WAVE':
+        return None
+
+    fmt = None
+    pos = 12
+
+    while pos + 8 <= len(buf):
+        chunk_id = buf[pos:pos + 4]
+        chunk_size = struct.unpack_from('<I', buf, pos + 4)[0]
+        body = pos + 8
+
+        if chunk_id == b'fmt ' and chunk_size >= 16:
+            format_tag, channels, rate, _, _, bits = struct.unpack_from('<HHIIHH', buf, body)
+
+            # the real format is in the sub-format GUID (first 2 bytes)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 26:
+                format_tag = struct.unpack_from('<H', buf, body + 24)[0]
+
+            fmt = (format_tag, channels, rate, bits)
+
+        elif chunk_id == b'data':
+            if fmt is None:
+                return None
+
+            # size can be wrong (e.g. 0xFFFFFFFF from streaming writers)
+            return fmt + (body, min(chunk_size, len(buf) - body))
+
+        # chunks are word aligned
+        pos = body + chunk_size + (chunk_size & 1)
+
+    return None
+
+#
+# samples as float32 mono, normalized as librosa (soundfile) does
+# None if the format is not handled here
+#
+def wav_samples(buf, header):
+    format_tag, channels, rate, bits, offset, size = header
+
+    if format_tag == WAVE_FORMAT_PCM and bits == 16:
+        count = size // 2
+        samples = np.frombuffer(buf, dtype='<i2', count=count - count % channels, offset=offset)
+        audio = samples.astype(np.float32) * np.float32(1. / 32768.)
+    elif format_tag == WAVE_FORMAT_IEEE_FLOAT and bits == 32:
+        count = size // 4
+        audio = np.frombuffer(buf, dtype='<f4', count=count - count % channels, offset=offset)
+    else:
+        return None
+
+    if channels > 1:
+        # as librosa.to_mono: mean of the channels
+        audio = np.mean(audio.reshape(-1, channels), axis=1, dtype=np.float32)
+
+    return audio
+
+#
+# decode the bytes of an audio file in a float32 mono signal at sample_rate
+# returns the signal and the path taken (PATH_FAST, PATH_RESAMPLE, PATH_LIBROSA)
+#
+def decode_audio(file, sample_rate):
+    header = parse_wav_header(file)
+    audio = wav_samples(file, header) if header is not None else None
+
+    if audio is None:
+        import librosa
+
+        audio, _ = librosa.load(io.BytesIO(file), sr=sample_rate, mono=True, dtype=np.float32)
+        path = PATH_LIBROSA
+    elif header[2] != sample_rate:
+        import librosa
+
+        audio = librosa.resample(audio, orig_sr=header[2], target_sr=sample_rate).astype(np.float32)
+        path = PATH_RESAMPLE
+    else:
+        path = PATH_FAST
+
+    # in the features processes: returned with the result, counted in the server
+    count("decode_path", path)
+
+    return audio, path